@@ -1,5 +1,9 @@
+import asyncio
 import json
+import os
 import random
+import threading
+from contextvars import ContextVar
 from logging import getLogger
 from typing import Dict, Iterator, List, Literal, Optional, Tuple
 
@@ -8,13 +12,60 @@ import yaml
 from openai.resources.chat.completions import ChatCompletionMessageParam
 from openai.types.chat.chat_completion import ChatCompletion, Choice
 
-from utils.local_storage import load_file, file_lock
+from utils.local_storage import file_lock, file_mtime, load_file
 
 from .dataclasses import OpenAIConfig
 
 logger = getLogger(__name__)
 
 
+class TokenUsage:
+    """A running total of the tokens used by LLM calls."""
+
+    def __init__(self):
+        self.total = 0
+
+    def add(self, tokens: int):
+        self.total += tokens
+
+
+# Set this to have the tokens used by LLM calls, made in this context, added
+# to a running total. Worker threads started with a copy of the context
+# (e.g. asyncio.to_thread) report to the same total.
+current_token_usage: ContextVar[Optional[TokenUsage]] = ContextVar(
+    "current_token_usage", default=None
+)
+
+
+_interface: Optional["GPTInterface"] = None
+_interface_pid: Optional[int] = None
+_interface_lock = threading.Lock()
+
+
+def get_gpt_interface() -> "GPTInterface":
+    """Return the GPTInterface shared by this process, building it on first
+    use. Its config is brought up to date with config.yaml on every call."""
+    global _interface, _interface_pid
+
+    # The OpenAI clients' connection pools don't survive a fork
+    if _interface is None or _interface_pid != os.getpid():
+        with _interface_lock:
+            if _interface is None or _interface_pid != os.getpid():
+                _interface = GPTInterface()
+                _interface_pid = os.getpid()
+            return _interface
+
+    _interface.reload_config()
+    return _interface
+
+
+async def get_gpt_interface_async() -> "GPTInterface":
+    """get_gpt_interface, for use on the event loop. Checking config.yaml
+    (and, on first use or after a change, loading it and building the OpenAI
+    clients) is blocking, so it's done on a worker thread."""
+    return await asyncio.to_thread(get_gpt_interface)
+
+
 class GPTInterface:
     """The GPTInterface class is responsible for managing OpenAI models,
     and parsing signal models into a form that can be read by the OpenAI API.
@@ -24,19 +75,33 @@ class GPTInterface:
 
     openai_config: OpenAIConfig
     llm: openai.OpenAI
+    async_llm: openai.AsyncOpenAI
 
     def __init__(self):
         logger.info("Initializing GPTInterface...")
 
-        # We re-load the configuration each time, to allow for dynamic changes
-        # without needing to restart the server.
+        self._config_mtime = None
+        self.reload_config()
+
+        # These hold connection pools, so should be reused as much as possible.
+        # See get_gpt_interface.
+        self.llm = openai.OpenAI()
+        self.async_llm = openai.AsyncOpenAI()
+
+    def reload_config(self):
+        """Re-read the OpenAI config, if config.yaml has changed since we last
+        read it. This allows for dynamic changes without needing to restart
+        the server."""
+        mtime = file_mtime("config.yaml")
+        if self._config_mtime is not None and mtime == self._config_mtime:
+            return
+
         config = yaml.safe_load(load_file("config.yaml"))
 
         self.openai_config = OpenAIConfig(**config["openai"])
+        self._config_mtime = mtime
         logger.info(f"OpenAI config: {self.openai_config}")
 
-        self.llm = openai.OpenAI()
-
     def reset(self):
         logger.info("Resetting GPTInterface costs...")
         self.total_prompt_tokens = {}
@@ -60,13 +125,7 @@ class GPTInterface:
         messages (List[str]): A list of messages in the chat history.
         """
 
-        match model:
-            case "fast":
-                use_model = self.openai_config.fast_model
-            case "quality":
-                use_model = self.openai_config.quality_model
-            case _:
-                raise ValueError(f"Invalid model: {model}")
+        use_model = self._chat_model(model)
 
         logger.info(f"Creating chat completion with {len(messages)} messages")
         for m in messages:
@@ -85,6 +144,43 @@ class GPTInterface:
 
         return chosen_response.message.content
 
+    async def generate_chat_completion_async(
+        self,
+        model: Literal["fast", "quality"],
+        messages: List[str],
+    ) -> str:
+        """As generate_chat_completion, but using the asyncio client, so that
+        the event loop is free while waiting for the AI."""
+        use_model = self._chat_model(model)
+
+        logger.info(f"Creating chat completion with {len(messages)} messages")
+        for m in messages:
+            logger.debug(m)
+
+        response: ChatCompletion = (
+            await self.async_llm.chat.completions.create(
+                messages=messages,
+                model=use_model,
+                **self.openai_config.chat_completion_kwargs,
+            )
+        )
+
+        # Updating the costs involves file I/O
+        await asyncio.to_thread(self.update_costs, response)
+
+        chosen_response: Choice = random.choice(response.choices)
+
+        return chosen_response.message.content
+
+    def _chat_model(self, model: Literal["fast", "quality"]) -> str:
+        match model:
+            case "fast":
+                return self.openai_config.fast_model
+            case "quality":
+                return self.openai_config.quality_model
+            case _:
+                raise ValueError(f"Invalid model: {model}")
+
     def create_chat_message(
         self,
         role: Literal["system", "user", "assistant"],
@@ -198,10 +294,27 @@ class GPTInterface:
         images = [r.b64_json for r in response.data]
         return images
 
+    async def generate_image_response_async(self, prompt: str) -> List[str]:
+        """As generate_image_response, but using the asyncio client."""
+
+        response = await self.async_llm.images.generate(
+            model=self.openai_config.image_model,
+            prompt=prompt,
+            response_format="b64_json",
+            **self.openai_config.image_generation_kwargs,
+        )
+
+        images = [r.b64_json for r in response.data]
+        return images
+
     def update_costs(self, response: ChatCompletion):
         """Update the costs of the models. Syncs the usage with the file."""
         logger.info(f"Updating costs from message: {response}")
 
+        token_usage = current_token_usage.get()
+        if token_usage is not None:
+            token_usage.add(response.usage.total_tokens)
+
         with file_lock("llm_usage.json") as f:
             usage_str = f.read()
             if not usage_str:
@@ -50,6 +50,7 @@ def main(config: Config):
             config.signal,
             config.redis,
             config.rabbitmq,
+            admins=config.razzler_brain.admins,
         )
         for _ in range(config.general.num_consumers)
     ]
@@ -1,13 +1,24 @@
+import asyncio
 import base64
-import json
+import contextvars
 import re
 from abc import ABC, abstractmethod
-from datetime import datetime
+from concurrent.futures import Executor
+from functools import cached_property, partial
 from logging import getLogger
-from typing import Dict, Iterator, List, Literal, Optional, Tuple, Union
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
 
-import pydantic
 import redis
+import redis.asyncio
 import tiktoken
 
 from ai_interface.llm import GPTInterface
@@ -18,25 +29,198 @@ from signal_interface.dataclasses import (
     OutgoingReaction,
     QuoteMessage,
 )
-from utils.local_storage import load_file, load_phonebook
+from signal_interface.history import HistoryEntry, decode_entry
+from signal_interface.history_store import iter_history
+from utils.local_storage import load_file
 from utils.mongo import (
     MongoConfig,
     UserPreferences,
-    get_mongo_db,
+    UserPreferencesCache,
+    get_preferences_collection,
     get_user_preferences,
-    initialize_preferences_collection,
 )
 
 from ..dataclasses import RazzlerBrainConfig
+from .triggers import Triggers
 
 logger = getLogger(__name__)
 
+HandlerResponse = Optional[
+    Union[OutgoingMessage, OutgoingReaction, IncomingMessage]
+]
+
+
+class HistoryPager:
+    """A chat's message history, most recent first, which is only fetched as
+    far as it's read. Entries are kept once fetched, so iterating again (e.g.
+    from another handler) only goes back to Redis for the older entries that
+    haven't been read yet."""
+
+    def __init__(self, redis_connection: redis.Redis, recipient: str):
+        self.recipient = recipient
+        self.entries: List[HistoryEntry] = []
+        self._raw = iter_history(redis_connection, recipient)
+        self._seen = set()
+
+    def __iter__(self) -> Iterator[HistoryEntry]:
+        i = 0
+        while True:
+            while i < len(self.entries):
+                yield self.entries[i]
+                i += 1
+
+            if not self._fetch_next():
+                logger.info(
+                    f"Read all {len(self.entries)} messages in the history"
+                    f" for {self.recipient}"
+                )
+                return
+
+    def _fetch_next(self) -> bool:
+        """Decode the next entry. Returns False at the end of the history."""
+        for msg_str in self._raw:
+            # Entries pushed while we're paging shift the list along, so the
+            # same entry can be read twice
+            if msg_str in self._seen:
+                continue
+            self._seen.add(msg_str)
+
+            entry = decode_entry(msg_str)
+            if entry is not None:
+                self.entries.append(entry)
+                return True
+
+        return False
+
+
+def fetch_history(
+    redis_connection: redis.Redis, recipient: str
+) -> HistoryPager:
+    """Get a chat's message history, most recent first. Nothing is fetched
+    until the history is iterated over."""
+    return HistoryPager(redis_connection, recipient)
+
+
+def entry_tokens(entry: HistoryEntry, enc: tiktoken.Encoding) -> int:
+    """How many tokens the entry's line is, using the count stored with it if
+    there is one."""
+    num_tokens = entry.tokens.get(enc.name)
+    if num_tokens is None:
+        num_tokens = len(enc.encode(entry.line))
+    return num_tokens
+
+
+class MessageContext:
+    """Everything the command handlers might want to know about a single
+    incoming message, beyond the message itself. Each item is only fetched
+    the first time a handler asks for it, and is then shared with all the
+    other handlers that run on the same message.
+
+    Handlers run one at a time for a given message, so no locking is done.
+
+    Fetching an item blocks (on the synchronous Redis client, Mongo, or the
+    disk), which is fine for synchronous handlers, since they run on worker
+    threads. Async handlers must fetch items with asyncio.to_thread; doing it
+    on the event loop raises a RuntimeError.
+    """
+
+    def __init__(
+        self,
+        message: IncomingMessage,
+        redis_connection: redis.Redis,
+        mongo_config: MongoConfig,
+    ):
+        self.message = message
+        self.redis_connection = redis_connection
+        self.mongo_config = mongo_config
+
+    @cached_property
+    def recipient(self) -> str:
+        return self.message.get_recipient()
+
+    @staticmethod
+    def _check_off_event_loop(name: str):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop in this thread, so we can block
+            return
+        raise RuntimeError(
+            f"MessageContext.{name} blocks, so can't be fetched on the event"
+            " loop. Use asyncio.to_thread."
+        )
+
+    @cached_property
+    def history(self) -> HistoryPager:
+        """The chat's message history, most recent first."""
+        self._check_off_event_loop("history")
+        return fetch_history(self.redis_connection, self.recipient)
+
+    def invalidate_history(self):
+        """Call when the message history has changed, so that it's fetched
+        again on next use."""
+        self.__dict__.pop("history", None)
+
+    @cached_property
+    def sender_prefs(self) -> UserPreferences:
+        self._check_off_event_loop("sender_prefs")
+        return load_user_prefs(
+            self.mongo_config, self.message.get_sender_id()
+        )
+
+    @cached_property
+    def images(self) -> List[Tuple[str, str]]:
+        """Images attached to the message."""
+        self._check_off_event_loop("images")
+        data_message = self.message.envelope.dataMessage
+        if not data_message:
+            return []
+        return CommandHandler.extract_images(data_message)
+
+    @cached_property
+    def quote_images(self) -> List[Tuple[str, str]]:
+        """Images attached to the message that this one quotes."""
+        self._check_off_event_loop("quote_images")
+        data_message = self.message.envelope.dataMessage
+        if not data_message or not data_message.quote:
+            return []
+        return CommandHandler.extract_images(data_message.quote)
+
+
+def load_user_prefs(
+    mongo_config: MongoConfig, user_id: str
+) -> UserPreferences:
+    """Return an object containing this users' preferences"""
+    preferences = CommandHandler.preferences_cache.get(user_id)
+    if preferences is None:
+        mongo_collection = get_preferences_collection(mongo_config)
+        preferences = get_user_preferences(mongo_collection, user_id)
+        CommandHandler.preferences_cache.put(user_id, preferences)
+    return preferences
+
 
 class CommandHandler(ABC):
     # TODO: This is currently quite specialised to work specifically with
     # signal messages. It would be nice to make this more generic, so that it
     # can be used with other messaging services.
 
+    # Shared by every handler in the process. The brain replaces this with a
+    # cache sized from its config, and invalidates entries when the user
+    # preferences API reports a change.
+    preferences_cache: UserPreferencesCache = UserPreferencesCache()
+
+    # Handlers that call the LLM are subject to the per-user and per-chat
+    # quotas. When a quota stops one, the user is told with a reaction.
+    # Handlers that respond without being asked only count against the
+    # chat's quotas, and are stopped silently.
+    llm_backed: bool = False
+    unprompted: bool = False
+
+    # What could make this handler handle a message. The brain only calls
+    # can_handle for messages that match; handlers without triggers see
+    # every message. See triggers.py.
+    triggers: Optional[Triggers] = None
+
     def __init__(self, mongo_config: MongoConfig):
         self.mongo_config = mongo_config
 
@@ -57,10 +241,11 @@ class CommandHandler(ABC):
     def get_chat_history_for_llm(
         self,
         config: RazzlerBrainConfig,
-        cache_key: str,
+        recipient: str,
         redis_connection: redis.Redis,
         gpt: GPTInterface,
         ai_model: Literal["fast", "quality"],
+        context: Optional[MessageContext] = None,
     ) -> List[Dict]:
         """Get the chat history from the cache, and parse it into a format
         that the AI can understand.
@@ -76,11 +261,11 @@ class CommandHandler(ABC):
         tokens differently.
         """
 
-        # Get the message history list from redis
-        history = redis_connection.lrange(cache_key, 0, -1)
-        logger.info(
-            f"Fetched {len(history)} messages from cache under key {cache_key}"
-        )
+        # Get the message history from redis, unless we already have it
+        if context is not None:
+            history = context.history
+        else:
+            history = fetch_history(redis_connection, recipient)
 
         messages = []
         num_tokens = 0
@@ -96,78 +281,34 @@ class CommandHandler(ABC):
         enc = tiktoken.encoding_for_model(ai_model)
         logger.info(f"Encoding for model: {enc}")
 
-        # Parse the messages into something the AI can understand
-        for msg_str in history:
-            msg_dict = json.loads(msg_str)
-            # Parse the message into the appropriate type
-            msg_models = [IncomingMessage, OutgoingMessage, OutgoingReaction]
-            for msg_model in msg_models:
-                try:
-                    msg = msg_model(**msg_dict)
-                    break
-                except pydantic.ValidationError:
-                    pass
-            else:
-                logger.error(f"Could not parse message: {msg_str}")
-
-            msg_out = ""
-            match msg:
-                case IncomingMessage():
-                    # Parse the UNIX timestamp (e.g. 1717075009) to a
-                    # human-readable format
-                    # Irritatingly, the timestamp is in milliseconds
-                    ts = msg.envelope.timestamp / 1000
-                    time_str = datetime.fromtimestamp(ts).strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
+        # Each line of the transcript was rendered and counted when it was
+        # stored. Working back from the most recent, take lines until the
+        # humans' messages fill the token budget.
+        for entry in history:
+            # Skips over things like reacts and other non-message events
+            if entry.line is None:
+                continue
+
+            if entry.kind == "outgoing_message":
+                messages.append(
+                    gpt.create_chat_message("assistant", entry.line)
+                )
+                continue
 
-                    # Skips over things like reacts and other non-message
-                    # events
-                    message_content = msg.envelope.dataMessage.message
-                    if message_content:
-                        msg_out = (
-                            f"{msg.envelope.sourceName} [{time_str}]:"
-                            f" {message_content}"
-                        )
-
-                        # How many tokens is this message?
-                        num_tokens += len(enc.encode(msg_out))
-
-                        # If we've reached the token limit, stop adding
-                        # messages and return
-                        if num_tokens < config.max_chat_history_tokens:
-                            messages.append(
-                                gpt.create_chat_message("user", msg_out)
-                            )
-                        else:
-                            logger.info(
-                                f"Reached token limit at: {num_tokens} tokens"
-                                f" over {len(messages)} messages"
-                            )
-                            # We built the messages history in reverse order,
-                            # starting with the most recent, so we need to
-                            # reverse it
-                            messages.reverse()
-
-                            if len(messages):
-                                logger.info(f"Oldest message: {messages[0]}")
-                                logger.info(
-                                    f"Most recent message: {messages[-1]}"
-                                )
-                            else:
-                                logger.info("No messages in history")
-
-                            return messages
-
-                case OutgoingMessage():
-                    msg_out = f"Razzler: {msg.message}"
-                    messages.append(
-                        gpt.create_chat_message("assistant", msg_out)
-                    )
+            num_tokens += entry_tokens(entry, enc)
+
+            # If we've reached the token limit, stop adding messages
+            if num_tokens >= config.max_chat_history_tokens:
+                logger.info(
+                    f"Reached token limit at: {num_tokens} tokens"
+                    f" over {len(messages)} messages"
+                )
+                break
 
-                case _:
-                    continue
+            messages.append(gpt.create_chat_message("user", entry.line))
 
+        # We built the messages history in reverse order, starting with the
+        # most recent, so we need to reverse it
         messages.reverse()
 
         if len(messages):
@@ -178,10 +319,7 @@ class CommandHandler(ABC):
         return messages
 
     def razzle_history_key(self, recipient: str) -> str:
-        return f"razzle_history:{recipient}"
-
-    def message_history_key(self, recipient: str) -> str:
-        return f"message_history:{recipient}"
+        return f"razzle_window:{recipient}"
 
     def generate_chat_message(
         self,
@@ -192,6 +330,7 @@ class CommandHandler(ABC):
         gpt: GPTInterface,
         model: Literal["fast", "quality"],
         images: Optional[List[Tuple[str, str]]] = None,
+        context: Optional[MessageContext] = None,
     ) -> str:
         """Generate a chat message in response to the given message.
         Note that images can be attached, but they're assumed to be
@@ -200,9 +339,12 @@ class CommandHandler(ABC):
         Model can be either "fast" or "quality"."""
 
         # Fetch the reply prompt
-        sid = message.get_sender_id()
-        logger.info(f"Fetching user preferences for {sid}")
-        user_prefs = self.get_user_prefs(sid)
+        if context is not None:
+            user_prefs = context.sender_prefs
+        else:
+            sid = message.get_sender_id()
+            logger.info(f"Fetching user preferences for {sid}")
+            user_prefs = self.get_user_prefs(sid)
         reply_prompt = getattr(user_prefs, prompt_key)
         personality_prompt = user_prefs.personality
 
@@ -211,9 +353,13 @@ class CommandHandler(ABC):
 
         messages = []
 
-        cache_key = self.message_history_key(message.get_recipient())
         history = self.get_chat_history_for_llm(
-            config, cache_key, redis_client, gpt, model
+            config,
+            message.get_recipient(),
+            redis_client,
+            gpt,
+            model,
+            context,
         )
 
         messages.extend(history)
@@ -280,8 +426,9 @@ class CommandHandler(ABC):
             timestamp=message.envelope.timestamp,
         )
 
+    @staticmethod
     def extract_images(
-        self, message: Union[DataMessage, QuoteMessage]
+        message: Union[DataMessage, QuoteMessage]
     ) -> List[Tuple[str, str]]:
         """Get the image data from images contained in the message directly,
         or those contained in the message's quotes.
@@ -293,8 +440,12 @@ class CommandHandler(ABC):
         images = []
 
         for attachment in message.attachments:
+            # Attachments that weren't downloaded (e.g. too large) have no data
+            if not attachment.data:
+                continue
+
             if attachment.contentType.startswith("image"):
-                b64_image = self.image_to_base64(attachment.data)
+                b64_image = CommandHandler.image_to_base64(attachment.data)
                 images.append(
                     (
                         attachment.contentType,
@@ -307,19 +458,11 @@ class CommandHandler(ABC):
     @staticmethod
     def get_recipient(message: IncomingMessage) -> str:
         """The sender can be either a single user, or a group."""
-        if message.envelope.dataMessage:
-            if message.envelope.dataMessage.groupInfo:
-                gid = message.envelope.dataMessage.groupInfo.groupId
-                phonebook = load_phonebook()
-                return phonebook.get_group_internal_id(gid)
-
-        return message.envelope.source
+        return message.get_recipient()
 
     def get_user_prefs(self, user_id: str) -> UserPreferences:
         """Return an object containing this users' preferences"""
-        db = get_mongo_db(self.mongo_config)
-        mongo_collection = initialize_preferences_collection(db)
-        return get_user_preferences(mongo_collection, user_id)
+        return load_user_prefs(self.mongo_config, user_id)
 
     @abstractmethod
     def can_handle(
@@ -327,6 +470,7 @@ class CommandHandler(ABC):
         message: IncomingMessage,
         redis_connection: Optional[redis.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         """Check if the command can handle the given message."""
         pass
@@ -337,8 +481,105 @@ class CommandHandler(ABC):
         message: IncomingMessage,
         redis_connection: redis.Redis,
         config: RazzlerBrainConfig,
-    ) -> Iterator[
-        Optional[Union[OutgoingMessage, OutgoingReaction, IncomingMessage]]
-    ]:
+        context: Optional[MessageContext] = None,
+    ) -> Iterator[HandlerResponse]:
         """Handle the incoming message and perform actions."""
         pass
+
+    async def can_handle_async(
+        self,
+        message: IncomingMessage,
+        redis_connection: redis.Redis,
+        config: RazzlerBrainConfig,
+        executor: Optional[Executor] = None,
+        context: Optional[MessageContext] = None,
+    ) -> bool:
+        """Run can_handle on a worker thread, so that its blocking calls
+        don't hold up the event loop."""
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            executor,
+            ctx.run,
+            partial(
+                self.can_handle, message, redis_connection, config, context
+            ),
+        )
+
+    async def handle_async(
+        self,
+        message: IncomingMessage,
+        redis_connection: redis.Redis,
+        config: RazzlerBrainConfig,
+        executor: Optional[Executor] = None,
+        context: Optional[MessageContext] = None,
+    ) -> AsyncIterator[HandlerResponse]:
+        """Drive the handle generator from a worker thread, one step at a
+        time. Each response is yielded back on the event loop as soon as it's
+        produced, so e.g. a reaction can be sent before a slow LLM call."""
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        responses = self.handle(message, redis_connection, config, context)
+
+        finished = object()
+        while True:
+            response = await loop.run_in_executor(
+                executor, ctx.run, next, responses, finished
+            )
+            if response is finished:
+                return
+            yield response
+
+
+class AsyncCommandHandler(CommandHandler):
+    """A command handler whose can_handle and handle are coroutines. These run
+    directly on the event loop, so must not block; they are given the asyncio
+    Redis client rather than the blocking one."""
+
+    @abstractmethod
+    async def can_handle(
+        self,
+        message: IncomingMessage,
+        redis_connection: Optional[redis.asyncio.Redis] = None,
+        config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
+    ) -> bool:
+        """Check if the command can handle the given message."""
+        pass
+
+    @abstractmethod
+    async def handle(
+        self,
+        message: IncomingMessage,
+        redis_connection: redis.asyncio.Redis,
+        config: RazzlerBrainConfig,
+        context: Optional[MessageContext] = None,
+    ) -> AsyncIterator[HandlerResponse]:
+        """Handle the incoming message and perform actions. Implementations
+        should be async generators."""
+        pass
+
+    async def can_handle_async(
+        self,
+        message: IncomingMessage,
+        redis_connection: redis.asyncio.Redis,
+        config: RazzlerBrainConfig,
+        executor: Optional[Executor] = None,
+        context: Optional[MessageContext] = None,
+    ) -> bool:
+        return await self.can_handle(
+            message, redis_connection, config, context
+        )
+
+    async def handle_async(
+        self,
+        message: IncomingMessage,
+        redis_connection: redis.asyncio.Redis,
+        config: RazzlerBrainConfig,
+        executor: Optional[Executor] = None,
+        context: Optional[MessageContext] = None,
+    ) -> AsyncIterator[HandlerResponse]:
+        async for response in self.handle(
+            message, redis_connection, config, context
+        ):
+            yield response
@@ -1,28 +1,34 @@
+import asyncio
 from logging import getLogger
-from typing import Iterator, Optional, Union
+from typing import AsyncIterator, Optional, Union
 
-import redis
+import redis.asyncio
 
-from ai_interface.llm import GPTInterface
+from ai_interface.llm import get_gpt_interface_async
 
 from ..dataclasses import RazzlerBrainConfig
 from .base_command import (
-    CommandHandler,
+    AsyncCommandHandler,
     IncomingMessage,
+    MessageContext,
     OutgoingMessage,
     OutgoingReaction,
 )
+from .triggers import Triggers
 
 logger = getLogger(__name__)
 
 
-class CreateImageCommandHandler(CommandHandler):
+class CreateImageCommandHandler(AsyncCommandHandler):
+    llm_backed = True
+    triggers = Triggers(prefixes=("dream",))
 
-    def can_handle(
+    async def can_handle(
         self,
         message: IncomingMessage,
-        redis_connection: Optional[redis.Redis] = None,
+        redis_connection: Optional[redis.asyncio.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not isinstance(message, IncomingMessage):
             return False
@@ -35,29 +41,38 @@ class CreateImageCommandHandler(CommandHandler):
 
         return message.envelope.dataMessage.message.lower().startswith("dream")
 
-    def handle(
+    async def handle(
         self,
         message: IncomingMessage,
-        redis_connection: redis.Redis,
+        redis_connection: redis.asyncio.Redis,
         config: RazzlerBrainConfig,
-    ) -> Iterator[Union[OutgoingMessage, OutgoingReaction]]:
+        context: Optional[MessageContext] = None,
+    ) -> AsyncIterator[Union[OutgoingMessage, OutgoingReaction]]:
         logger.info("Handling create image command")
 
         yield self.generate_reaction("🎨", message)
 
         try:
-            gpt = GPTInterface()
+            gpt = await get_gpt_interface_async()
 
             # Trim of the "dream" part of the message to get user-given prompt
             prompt = message.envelope.dataMessage.message[5:]
 
             # If the user didn't give a prompt, use a default one
             if not prompt:
-                user_prefs = self.get_user_prefs(message.get_sender_id())
+                # Fetching preferences is blocking, so do it off the loop
+                if context is not None:
+                    user_prefs = await asyncio.to_thread(
+                        lambda: context.sender_prefs
+                    )
+                else:
+                    user_prefs = await asyncio.to_thread(
+                        self.get_user_prefs, message.get_sender_id()
+                    )
                 prompt = user_prefs.dream_prompt
 
             prompt = prompt.strip()
-            created_images = gpt.generate_image_response(prompt)
+            created_images = await gpt.generate_image_response_async(prompt)
 
             logger.info(f"Creating an image from prompt: {prompt}")
 
@@ -71,5 +86,5 @@ class CreateImageCommandHandler(CommandHandler):
 
         except Exception as e:
             logger.error(f"Error creating image: {e}")
-            self.generate_reaction("❌", message)
+            yield self.generate_reaction("❌", message)
             raise e
@@ -1,21 +1,29 @@
 from logging import getLogger
-from typing import Iterator, Optional
+from typing import AsyncIterator, Optional
 
-import redis
+import redis.asyncio
 
 from ..dataclasses import RazzlerBrainConfig
-from .base_command import CommandHandler, IncomingMessage, OutgoingMessage
+from .base_command import (
+    AsyncCommandHandler,
+    IncomingMessage,
+    MessageContext,
+    OutgoingMessage,
+)
+from .triggers import Triggers
 
 logger = getLogger(__name__)
 
 
-class PingCommandHandler(CommandHandler):
+class PingCommandHandler(AsyncCommandHandler):
+    triggers = Triggers(keywords={"ping"})
 
-    def can_handle(
+    async def can_handle(
         self,
         message: IncomingMessage,
-        redis_connection: Optional[redis.Redis] = None,
+        redis_connection: Optional[redis.asyncio.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not isinstance(message, IncomingMessage):
             return False
@@ -28,12 +36,13 @@ class PingCommandHandler(CommandHandler):
 
         return message.envelope.dataMessage.message.lower() == "ping"
 
-    def handle(
+    async def handle(
         self,
         message: IncomingMessage,
-        redis_connection: redis.Redis,
+        redis_connection: redis.asyncio.Redis,
         config: RazzlerBrainConfig,
-    ) -> Iterator[OutgoingMessage]:
+        context: Optional[MessageContext] = None,
+    ) -> AsyncIterator[OutgoingMessage]:
         logger.info("Handling ping command")
         response_message = OutgoingMessage(
             recipient=self.get_recipient(message), message="PONG"
@@ -4,7 +4,12 @@ from typing import Iterator, Optional
 import redis
 
 from ..dataclasses import RazzlerBrainConfig
-from .base_command import CommandHandler, IncomingMessage, OutgoingMessage
+from .base_command import (
+    CommandHandler,
+    IncomingMessage,
+    MessageContext,
+    OutgoingMessage,
+)
 
 logger = getLogger(__name__)
 
@@ -16,6 +21,7 @@ class CharacterProfileCommandHandler(CommandHandler):
         message: IncomingMessage,
         redis_connection: Optional[redis.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not isinstance(message, IncomingMessage):
             return False
@@ -33,6 +39,7 @@ class CharacterProfileCommandHandler(CommandHandler):
         message: IncomingMessage,
         redis_connection: redis.Redis,
         config: RazzlerBrainConfig,
+        context: Optional[MessageContext] = None,
     ) -> Iterator[None]:
 
         logger.info(
@@ -1,20 +1,29 @@
 from logging import getLogger
-from typing import Iterator, Optional
+from typing import AsyncIterator, Optional
 
-import redis
+import redis.asyncio
 
 from ..dataclasses import RazzlerBrainConfig
-from .base_command import CommandHandler, IncomingMessage, OutgoingReaction
+from .base_command import (
+    AsyncCommandHandler,
+    IncomingMessage,
+    MessageContext,
+    OutgoingReaction,
+)
+from .triggers import Triggers
 
 logger = getLogger(__name__)
 
 
-class ReactCommandHandler(CommandHandler):
-    def can_handle(
+class ReactCommandHandler(AsyncCommandHandler):
+    triggers = Triggers(keywords={"react"})
+
+    async def can_handle(
         self,
         message: IncomingMessage,
-        redis_connection: Optional[redis.Redis] = None,
+        redis_connection: Optional[redis.asyncio.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not isinstance(message, IncomingMessage):
             return False
@@ -27,12 +36,13 @@ class ReactCommandHandler(CommandHandler):
 
         return message.envelope.dataMessage.message.lower() == "react"
 
-    def handle(
+    async def handle(
         self,
         message: IncomingMessage,
-        redis_connection: redis.Redis,
+        redis_connection: redis.asyncio.Redis,
         config: RazzlerBrainConfig,
-    ) -> Iterator[OutgoingReaction]:
+        context: Optional[MessageContext] = None,
+    ) -> AsyncIterator[OutgoingReaction]:
         logger.info("Handling react command")
         yield self.generate_reaction(
             message=message,
@@ -5,13 +5,14 @@ from typing import Iterator, Optional
 import advertools as adv
 import redis
 
-from ai_interface.llm import GPTInterface
+from ai_interface.llm import get_gpt_interface
 from razzler_brain.dataclasses import RazzlerBrainConfig
 from signal_interface.dataclasses import (
     IncomingMessage,
     OutgoingReaction,
 )
 
+from .base_command import MessageContext
 from .reply import ReplyCommandHandler
 
 logger = getLogger(__name__)
@@ -27,11 +28,16 @@ class ReactToChatCommandHandler(ReplyCommandHandler):
     frequency is reached, the razzler will always say something.
     """
 
+    unprompted = True
+    # Any message might be reacted to
+    triggers = None
+
     def can_handle(
         self,
         message: IncomingMessage,
         redis_connection: Optional[redis.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
 
         if not isinstance(message, IncomingMessage):
@@ -43,7 +49,10 @@ class ReactToChatCommandHandler(ReplyCommandHandler):
         if not message.envelope.dataMessage.message:
             return False
 
-        prefs = self.get_user_prefs(message.get_sender_id())
+        if context is not None:
+            prefs = context.sender_prefs
+        else:
+            prefs = self.get_user_prefs(message.get_sender_id())
         frequency = prefs.react_frequency
 
         return random.random() < frequency
@@ -58,10 +67,11 @@ class ReactToChatCommandHandler(ReplyCommandHandler):
         message: IncomingMessage,
         redis_connection: redis.Redis,
         config: RazzlerBrainConfig,
+        context: Optional[MessageContext] = None,
     ) -> Iterator[OutgoingReaction]:
         """Ask the AI to choose a reaction emoji for a message."""
 
-        gpt = GPTInterface()
+        gpt = get_gpt_interface()
 
         response = self.generate_chat_message(
             config=config,
@@ -70,6 +80,7 @@ class ReactToChatCommandHandler(ReplyCommandHandler):
             gpt=gpt,
             redis_client=redis_connection,
             model="fast",
+            context=context,
         )
 
         logger.info(f"Asked the Razzler for an emoji. Response: '{response}'")
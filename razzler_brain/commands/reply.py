@@ -1,59 +1,66 @@
-from datetime import datetime
 from logging import getLogger
-from typing import Iterator, Optional, Union
+from typing import Iterator, Optional, Tuple, Union
 
 import redis
 
-from ai_interface.llm import GPTInterface
+from ai_interface.llm import get_gpt_interface
 from signal_interface.dataclasses import OutgoingReaction
+from utils.rate_limit import SlidingWindowCounter
 
 from ..dataclasses import RazzlerBrainConfig
-from .base_command import CommandHandler, IncomingMessage, OutgoingMessage
+from .base_command import (
+    CommandHandler,
+    IncomingMessage,
+    MessageContext,
+    OutgoingMessage,
+)
+from .triggers import Triggers
 
 logger = getLogger(__name__)
 
 
 class ReplyCommandHandler(CommandHandler):
     prompt_key = "reply"
+    llm_backed = True
+    triggers = Triggers(mentions_self=True)
 
     # We can only reply so many times in a row
     time_window = 60 * 1
     max_replies = 100
 
-    def count_razzler_messages_in_window(
-        self,
-        message: IncomingMessage,
-        time_window: int,
-        redis_connection: redis.Redis,
-    ):
-
-        # Get the message history list from redis
+    # Replies, per chat. This is shared by all the reply handlers, which
+    # count them over their own time windows.
+    razzle_counter = SlidingWindowCounter(retention=60 * 60 * 24)
+
+    def claim_reply(
+        self, message: IncomingMessage, redis_connection: redis.Redis
+    ) -> Tuple[bool, int]:
+        """Count a reply to the message, if there haven't already been
+        max_replies in the last time_window seconds. Checking and counting
+        is atomic, so replies handled at the same time can't all squeeze
+        under the limit. Returns whether the reply may go ahead, and how
+        many replies there have been in the window.
+
+        A reply is counted before it's generated, so one that fails still
+        counts. That way, a failing LLM isn't asked again and again.
+        """
         cache_key = self.razzle_history_key(message.get_recipient())
-        history = redis_connection.lrange(cache_key, 0, -1)
-        # This is a list of datetime strings.
-        # Count how many there are in the last time_window seconds
-        now = message.envelope.timestamp / 1000
-        now = datetime.fromtimestamp(now)
-
-        count = 0
-        for timestamp in history:
-            timestamp = datetime.fromisoformat(timestamp.decode())
-            if (now - timestamp).total_seconds() < time_window:
-                count += 1
+        allowed, count = self.razzle_counter.hit(
+            redis_connection, cache_key, self.time_window, self.max_replies
+        )
 
         logger.info(
-            f"Counted {count} messages in the last {time_window} seconds (max"
-            f" {self.max_replies})"
+            f"Counted {count} messages in the last {self.time_window} seconds"
+            f" (max {self.max_replies})"
         )
-
-        # If we have too many messages in the window, return false
-        return count
+        return bool(allowed), count
 
     def can_handle(
         self,
         message: IncomingMessage,
         redis_connection: Optional[redis.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not isinstance(message, IncomingMessage):
             return False
@@ -78,15 +85,14 @@ class ReplyCommandHandler(CommandHandler):
         message: IncomingMessage,
         redis_connection: redis.Redis,
         config: RazzlerBrainConfig,
+        context: Optional[MessageContext] = None,
     ) -> Iterator[Union[OutgoingMessage, OutgoingReaction]]:
         logger.info("Handling reply command")
 
         yield self.generate_reaction("🧠", message)
 
-        recent_razzing = self.count_razzler_messages_in_window(
-            message, self.time_window, redis_connection
-        )
-        if recent_razzing >= self.max_replies:
+        allowed, recent_razzing = self.claim_reply(message, redis_connection)
+        if not allowed:
             logger.info(
                 f"Too many razzles in the last {self.time_window} seconds."
                 f" I've already been summoned {recent_razzing} times."
@@ -105,20 +111,24 @@ class ReplyCommandHandler(CommandHandler):
 
         images = []
 
-        # Handle the case where the message contains an image
-        datamessage = message.envelope.dataMessage
-        images += self.extract_images(datamessage)
+        if context is not None:
+            images += context.images
+            images += context.quote_images
+        else:
+            # Handle the case where the message contains an image
+            datamessage = message.envelope.dataMessage
+            images += self.extract_images(datamessage)
 
-        # Handle the case where the message contains a quote with an image
-        quote = message.envelope.dataMessage.quote
-        if quote:
-            images += self.extract_images(quote)
+            # Handle the case where the message contains a quote with an image
+            quote = message.envelope.dataMessage.quote
+            if quote:
+                images += self.extract_images(quote)
 
         logger.info(f"Extracted {len(images)} images from message")
 
         # Then, get the response.
         try:
-            gpt = GPTInterface()
+            gpt = get_gpt_interface()
             response = self.generate_chat_message(
                 config,
                 message,
@@ -127,6 +137,7 @@ class ReplyCommandHandler(CommandHandler):
                 gpt,
                 "quality",
                 images,
+                context,
             )
 
             # The LLM may prefix its messages, so remove them if needed.
@@ -146,9 +157,4 @@ class ReplyCommandHandler(CommandHandler):
         )
         yield response_message
 
-        # Add the current time to the razzle history list
-        cache_key = self.razzle_history_key(message.get_recipient())
-        now = datetime.now()
-        redis_connection.lpush(cache_key, now.isoformat())
-
         yield self.generate_reaction("✅", message)
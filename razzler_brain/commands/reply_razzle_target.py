@@ -4,7 +4,7 @@ from typing import Optional
 import redis
 
 from ..dataclasses import RazzlerBrainConfig
-from .base_command import IncomingMessage
+from .base_command import IncomingMessage, MessageContext
 from .reply import ReplyCommandHandler
 
 logger = getLogger(__name__)
@@ -18,6 +18,7 @@ class ReplyRazzleTargetCommandHandler(ReplyCommandHandler):
         message: IncomingMessage,
         redis_connection: Optional[redis.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not isinstance(message, IncomingMessage):
             return False
@@ -1,14 +1,14 @@
-import json
 import random
 from logging import getLogger
 from typing import Optional
 
-import pydantic
 import redis
 
 from razzler_brain.dataclasses import RazzlerBrainConfig
-from signal_interface.dataclasses import IncomingMessage, OutgoingMessage
+from signal_interface.activity import count_activity
+from signal_interface.dataclasses import IncomingMessage
 
+from .base_command import MessageContext
 from .reply import ReplyCommandHandler
 
 logger = getLogger(__name__)
@@ -27,63 +27,37 @@ class ReplyWhenActiveChatCommandHandler(ReplyCommandHandler):
     # Maximum time to scan, in seconds.
     time_window = 60 * 60 * 3
 
+    unprompted = True
+    # Any message can make the chat active enough
+    triggers = None
+
     def can_handle(
         self,
         message: IncomingMessage,
         redis_connection: Optional[redis.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
 
         if not isinstance(message, IncomingMessage):
             return False
 
-        cache_key = self.message_history_key(message.get_recipient())
-        history = redis_connection.lrange(cache_key, 0, -1)
-
-        if len(history) < 2:
-            return False
-
-        # Each incoming message has a timestamp. Count how many messages were
-        # sent within some number of seconds of the current message.
-        time_window = self.time_window * 1000  # ms
-
-        count = 0
-        last_msg_time = message.envelope.timestamp
-        for record in history:
-            try:
-                msg = IncomingMessage(**json.loads(record))
-
-                if not msg.envelope.dataMessage:
-                    # Don't count receipt messages
-                    continue
-
-                this_timestamp = msg.envelope.timestamp
-                if abs(this_timestamp - last_msg_time) > time_window:
-                    break
-
-                count += 1
-                logger.debug(
-                    f"Counting message: {msg.envelope.dataMessage.message}"
-                )
-            except pydantic.ValidationError:
-                # If the window contains a razzler message, stop counting
-                try:
-                    OutgoingMessage(**json.loads(record))
-
-                    logger.debug(
-                        "Found a razzler reply. Stopping counting messages"
-                    )
-                    break
-
-                except pydantic.ValidationError:
-                    # If we get here, it's an OutgoingReaction
-                    continue
+        # The consumer keeps count of the messages received since the razzler
+        # last spoke, so only count those within some number of seconds of
+        # the current message.
+        since = message.envelope.timestamp - self.time_window * 1000  # ms
+        count = count_activity(
+            redis_connection, message.get_recipient(), since
+        )
 
         logger.info(
             f"Found {count} messages within {self.time_window} seconds"
         )
 
-        prefs = self.get_user_prefs(message.get_sender_id())
+        if context is not None:
+            prefs = context.sender_prefs
+        else:
+            prefs = self.get_user_prefs(message.get_sender_id())
         maximum_frequency = prefs.reply_when_active_chat_max_frequency
         minimum_frequency = prefs.reply_when_active_chat_min_frequency
 
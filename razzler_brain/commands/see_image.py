@@ -4,15 +4,17 @@ from typing import Iterator, List, Optional, Tuple, Union
 
 import redis
 
-from ai_interface.llm import GPTInterface
+from ai_interface.llm import get_gpt_interface
 
 from ..dataclasses import RazzlerBrainConfig
 from .base_command import (
     CommandHandler,
     IncomingMessage,
+    MessageContext,
     OutgoingMessage,
     OutgoingReaction,
 )
+from .triggers import Triggers
 
 logger = getLogger(__name__)
 
@@ -25,11 +27,16 @@ class SeeImageCommandHandler(CommandHandler):
     Injected image descriptions are enclosed in [[[ ]]] brackets.
     """
 
+    llm_backed = True
+    unprompted = True
+    triggers = Triggers(has_image=True)
+
     def can_handle(
         self,
         message: IncomingMessage,
         redis_connection: Optional[redis.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not isinstance(message, IncomingMessage):
             return False
@@ -41,7 +48,8 @@ class SeeImageCommandHandler(CommandHandler):
             return False
 
         for attachment in message.envelope.dataMessage.attachments:
-            if attachment.contentType.startswith("image"):
+            # Images that weren't downloaded (e.g. too large) can't be seen
+            if attachment.data and attachment.contentType.startswith("image"):
                 return True
 
         return False
@@ -51,6 +59,7 @@ class SeeImageCommandHandler(CommandHandler):
         message: IncomingMessage,
         redis_connection: redis.Redis,
         config: RazzlerBrainConfig,
+        context: Optional[MessageContext] = None,
     ) -> Iterator[Union[OutgoingReaction, OutgoingMessage, IncomingMessage]]:
         logger.info("Digesting an image message")
         yield self.generate_reaction("🕵️", message)
@@ -60,24 +69,32 @@ class SeeImageCommandHandler(CommandHandler):
 
         try:
             # Handle the case where the image is attached to the message
-            images = self.extract_images(message.envelope.dataMessage)
+            if context is not None:
+                images = context.images
+            else:
+                images = self.extract_images(message.envelope.dataMessage)
 
             if images:
                 logger.info(f"Extracted {len(images)} images from message")
-                response = self.generate_images_description(images, message)
+                response = self.generate_images_description(
+                    images, message, context
+                )
                 yield self.update_message_with_description(message, response)
 
             # Handle the case where the image is quoted in the message
             if message.envelope.dataMessage.quote:
                 logger.info("This message contains a quote")
-                images = self.extract_images(
-                    message.envelope.dataMessage.quote
-                )
+                if context is not None:
+                    images = context.quote_images
+                else:
+                    images = self.extract_images(
+                        message.envelope.dataMessage.quote
+                    )
 
                 if images:
                     logger.info(f"Extracted {len(images)} images from quote")
                     response = self.generate_images_description(
-                        images, message
+                        images, message, context
                     )
                     yield self.update_quote_with_description(message, response)
 
@@ -91,11 +108,15 @@ class SeeImageCommandHandler(CommandHandler):
         self,
         images: List[Tuple[str, str]],
         message: IncomingMessage,
+        context: Optional[MessageContext] = None,
     ):
-        gpt = GPTInterface()
+        gpt = get_gpt_interface()
 
         # Get the user preference for image descriptions
-        user_prefs = self.get_user_prefs(message.get_sender_id())
+        if context is not None:
+            user_prefs = context.sender_prefs
+        else:
+            user_prefs = self.get_user_prefs(message.get_sender_id())
         describe_image_prompt = user_prefs.describe_image
         logger.info(f"Describing image using prompt: {describe_image_prompt}")
 
@@ -1,26 +1,32 @@
 from logging import getLogger
-from typing import Iterator, Optional
+from typing import AsyncIterator, Optional
 
-import redis
+import redis.asyncio
 
-from ai_interface.llm import GPTInterface
+from ai_interface.llm import get_gpt_interface_async
 
 from ..dataclasses import RazzlerBrainConfig
 from .base_command import (
-    CommandHandler,
+    AsyncCommandHandler,
     IncomingMessage,
+    MessageContext,
     OutgoingMessage,
 )
+from .triggers import Triggers
 
 logger = getLogger(__name__)
 
 
-class SummonCommandHandler(CommandHandler):
-    def can_handle(
+class SummonCommandHandler(AsyncCommandHandler):
+    llm_backed = True
+    triggers = Triggers(keywords={"summon"})
+
+    async def can_handle(
         self,
         message: IncomingMessage,
-        redis_connection: Optional[redis.Redis] = None,
+        redis_connection: Optional[redis.asyncio.Redis] = None,
         config: Optional[RazzlerBrainConfig] = None,
+        context: Optional[MessageContext] = None,
     ) -> bool:
         if not message.envelope.dataMessage:
             return False
@@ -30,17 +36,18 @@ class SummonCommandHandler(CommandHandler):
 
         return message.envelope.dataMessage.message.lower() == "summon"
 
-    def handle(
+    async def handle(
         self,
         message: IncomingMessage,
-        redis_connection: redis.Redis,
+        redis_connection: redis.asyncio.Redis,
         config: RazzlerBrainConfig,
-    ) -> Iterator[OutgoingMessage]:
+        context: Optional[MessageContext] = None,
+    ) -> AsyncIterator[OutgoingMessage]:
         logger.info("Handling summon command")
 
         try:
-            gpt = GPTInterface()
-            response = gpt.generate_chat_completion(
+            gpt = await get_gpt_interface_async()
+            response = await gpt.generate_chat_completion_async(
                 model="fast",
                 messages=[
                     gpt.create_chat_message(
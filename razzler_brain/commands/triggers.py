@@ -0,0 +1,118 @@
+"""Cheap, declarative tests for which commands might handle a message.
+
+Each command can declare the Triggers that could make it handle a message,
+e.g. the message being exactly "ping", or mentioning the Razzler. The brain
+compiles the triggers of all its commands into a TriggerIndex, and only asks
+the commands that the index picks out whether they can handle the message.
+This saves the other commands' can_handle from doing Redis reads, Mongo
+lookups and the like for messages they'd never handle.
+
+Triggers only narrow down the commands to ask; a command's can_handle still
+has the final say. Commands without triggers are always asked.
+"""
+
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, Set, Tuple
+
+from pydantic import BaseModel
+
+from signal_interface.dataclasses import IncomingMessage
+
+from ..dataclasses import RazzlerBrainConfig
+
+if TYPE_CHECKING:
+    from .base_command import CommandHandler
+
+
+class Triggers(BaseModel):
+    """A command is a candidate for a message if any of these match."""
+
+    # The whole message text, lower-cased
+    keywords: FrozenSet[str] = frozenset()
+    # The start of the message text, lower-cased
+    prefixes: Tuple[str, ...] = ()
+    # The message mentions the Razzler
+    mentions_self: bool = False
+    # The message has an image attached, which was downloaded
+    has_image: bool = False
+    # The message was sent by an admin
+    from_admin: bool = False
+
+
+def _has_image(message: IncomingMessage) -> bool:
+    attachments = message.envelope.dataMessage.attachments or []
+    # Images that weren't downloaded have no data, so don't count
+    return any(
+        attachment.data and attachment.contentType.startswith("image")
+        for attachment in attachments
+    )
+
+
+def _mentions_self(
+    message: IncomingMessage, config: RazzlerBrainConfig
+) -> bool:
+    mentions = message.envelope.dataMessage.mentions or []
+    return any(
+        mention.number == config.razzler_phone_number for mention in mentions
+    )
+
+
+class TriggerIndex:
+    """Maps the features of a message to the commands they might trigger.
+
+    Commands are referred to by their position in the list given, so that
+    the candidates for a message come back in the same (priority) order.
+    """
+
+    def __init__(self, commands: List["CommandHandler"]):
+        self.commands = commands
+
+        self.keywords: Dict[str, Set[int]] = {}
+        self.prefixes: List[Tuple[str, int]] = []
+        self.mentions_self: Set[int] = set()
+        self.has_image: Set[int] = set()
+        self.from_admin: Set[int] = set()
+        self.always: Set[int] = set()
+
+        for i, command in enumerate(commands):
+            triggers = command.triggers
+            if triggers is None:
+                self.always.add(i)
+                continue
+
+            for keyword in triggers.keywords:
+                self.keywords.setdefault(keyword.lower(), set()).add(i)
+            for prefix in triggers.prefixes:
+                self.prefixes.append((prefix.lower(), i))
+            if triggers.mentions_self:
+                self.mentions_self.add(i)
+            if triggers.has_image:
+                self.has_image.add(i)
+            if triggers.from_admin:
+                self.from_admin.add(i)
+
+    def candidates(
+        self, message: IncomingMessage, config: RazzlerBrainConfig
+    ) -> List["CommandHandler"]:
+        """The commands that might handle the message, in priority order."""
+        matched = set(self.always)
+
+        data_message = message.envelope.dataMessage
+        if data_message:
+            text = data_message.message
+            if isinstance(text, str):
+                text = text.lower()
+                matched |= self.keywords.get(text, set())
+                for prefix, i in self.prefixes:
+                    if text.startswith(prefix):
+                        matched.add(i)
+
+            if self.mentions_self and _mentions_self(message, config):
+                matched |= self.mentions_self
+
+            if self.has_image and _has_image(message):
+                matched |= self.has_image
+
+        if self.from_admin and message.envelope.sourceNumber in config.admins:
+            matched |= self.from_admin
+
+        return [self.commands[i] for i in sorted(matched)]
@@ -1,6 +1,8 @@
 from typing import List
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from utils.quota import QuotaConfig
 
 
 class RazzlerBrainConfig(BaseModel):
@@ -8,3 +10,19 @@ class RazzlerBrainConfig(BaseModel):
     admins: List[str]
     razzler_phone_number: str
     max_chat_history_tokens: int = 2048
+    # How many unacknowledged messages to take from the queue at once, and
+    # how many chats may be processed concurrently. Messages within a single
+    # chat are always processed one at a time, in order.
+    prefetch_count: int = 32
+    max_concurrent_chats: int = 8
+    # Worker threads for running synchronous command handlers
+    handler_threads: int = 8
+    # On shutdown, how long (in seconds) to wait for messages that are being
+    # processed to finish. Any still going are redelivered by RabbitMQ.
+    shutdown_timeout: float = 30.0
+    # User preferences are cached in the brain, and dropped from the cache
+    # when they're changed through the preferences API, or after ttl seconds
+    preferences_cache_size: int = 1024
+    preferences_cache_ttl: float = 300.0
+    # Limits on how much each user, and each chat, can use the LLM
+    quotas: QuotaConfig = Field(default_factory=QuotaConfig)
@@ -4,20 +4,41 @@ in the outgoing_messages queue."""
 
 import asyncio
 import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from logging import getLogger
-from typing import List
+from typing import List, Union
 
 import aio_pika
 import redis
+import redis.asyncio
 
+from ai_interface.llm import TokenUsage, current_token_usage
 from signal_interface.dataclasses import IncomingMessage, OutgoingReaction
+from signal_interface.history_store import replace_message
+from signal_interface.whitelist import WHITELIST_KEY, WHITELIST_UPDATED_CHANNEL
 from utils.local_storage import file_lock, load_file
-from utils.redis import RedisCredentials
-from utils.mongo import MongoConfig
-
-from .commands.base_command import CommandHandler
+from utils.mongo import (
+    PREFERENCES_UPDATED_CHANNEL,
+    MongoConfig,
+    UserPreferencesCache,
+)
+from utils.quota import QuotaEnforcer
+from utils.redis import (
+    RedisCredentials,
+    get_async_redis_client,
+    subscribe_forever,
+)
+
+from .commands.base_command import (
+    AsyncCommandHandler,
+    CommandHandler,
+    MessageContext,
+)
 from .commands.registry import COMMAND_PROCESSING_ORDER, COMMAND_REGISTRY
+from .commands.triggers import TriggerIndex
 from .dataclasses import RazzlerBrainConfig
+from .scheduler import ChatScheduler
 
 logger = getLogger(__name__)
 
@@ -35,11 +56,39 @@ class RazzlerBrain:
     ):
         self.brain_config = brain_config
         self.rabbit_config = rabbit_config
+        self.mongo_config = mongo_config
         self.redis_client = redis.Redis(
             host=redis_config.host,
             port=redis_config.port,
             db=redis_config.db,
             password=redis_config.password,
+            max_connections=redis_config.max_connections,
+            health_check_interval=redis_config.health_check_interval,
+        )
+        # The brain's own Redis traffic goes through the asyncio client, so
+        # that it never blocks the event loop. Command handlers have a
+        # synchronous interface, and so still use the blocking client above.
+        self.async_redis_client = get_async_redis_client(redis_config)
+        self.preferences_listener = None
+
+        # Limits on LLM use, per user and per chat
+        self.quota = QuotaEnforcer(brain_config.quotas)
+
+        # Messages within a chat are processed in order, but different chats
+        # are processed concurrently.
+        self.scheduler = ChatScheduler(brain_config.max_concurrent_chats)
+
+        # Synchronous command handlers (and their blocking LLM calls) run on
+        # this pool, so that they don't block the event loop.
+        self.executor = ThreadPoolExecutor(
+            max_workers=brain_config.handler_threads,
+            thread_name_prefix="razzler-handler",
+        )
+
+        # Shared by all the command handlers
+        CommandHandler.preferences_cache = UserPreferencesCache(
+            maxsize=brain_config.preferences_cache_size,
+            ttl=brain_config.preferences_cache_ttl,
         )
 
         # Register the commands with the brain
@@ -56,6 +105,10 @@ class RazzlerBrain:
                 # e.g. prompt filenames
                 self.commands.append(COMMAND_REGISTRY[command](mongo_config))
 
+        # Used to pick out which commands might handle each message, so that
+        # the rest needn't be asked
+        self.trigger_index = TriggerIndex(self.commands)
+
         # Check for any whitelisted groups
         whitelisted_groups = load_file(self.whitelist_file)
         if whitelisted_groups:
@@ -71,7 +124,8 @@ class RazzlerBrain:
         )
         # If we have any, add them to the Redis set
         if whitelisted_groups:
-            self.redis_client.sadd("whitelisted_groups", *whitelisted_groups)
+            self.redis_client.sadd(WHITELIST_KEY, *whitelisted_groups)
+            self.redis_client.publish(WHITELIST_UPDATED_CHANNEL, "")
 
     async def consume_messages(self):
         """Consume messages from RabbitMQ and process them."""
@@ -84,12 +138,24 @@ class RazzlerBrain:
         # Open a channel and consume incoming messages
         async with self.connection:
             self.channel = await self.connection.channel()
+            # Prefetch enough messages to keep several chats busy at once
+            await self.channel.set_qos(
+                prefetch_count=self.brain_config.prefetch_count
+            )
             queue = await self.channel.declare_queue(
                 "incoming_messages", durable=True
             )
-            await queue.consume(self._process_incoming_message)
+            consumer_tag = await queue.consume(
+                self._schedule_incoming_message
+            )
             logger.info("Consuming messages...")
-            await asyncio.Future()
+            try:
+                await asyncio.Future()
+            finally:
+                # Stop taking new messages, and let the ones we have finish
+                # (and be acknowledged) before the connection closes
+                await queue.cancel(consumer_tag)
+                await self.drain()
 
     def get_rabbitmq_connection(self):
         return aio_pika.connect_robust(**self.rabbit_config)
@@ -107,11 +173,54 @@ class RazzlerBrain:
     async def start(self):
         """Start consuming messages from RabbitMQ."""
         logger.info("Starting RazzlerBrain...")
+        self.preferences_listener = asyncio.create_task(
+            self.listen_for_preference_updates()
+        )
         await self._init_mq()
         await self.consume_messages()
 
+    async def listen_for_preference_updates(self):
+        """Drop users' cached preferences when the preferences API reports
+        that they've changed."""
+        cache = CommandHandler.preferences_cache
+
+        async def invalidate_all():
+            cache.invalidate()
+
+        async def invalidate_user(data: bytes):
+            user_id = data.decode()
+            logger.debug(f"Preferences changed for {user_id}")
+            cache.invalidate(user_id)
+
+        await subscribe_forever(
+            self.async_redis_client,
+            PREFERENCES_UPDATED_CHANNEL,
+            invalidate_all,
+            invalidate_user,
+        )
+
+    async def drain(self):
+        """Wait for the messages already taken from the queue to be
+        processed, for up to shutdown_timeout seconds."""
+        logger.info("Waiting for messages in progress to finish...")
+        # Shielded, so that timing out doesn't cancel the jobs themselves,
+        # which would reject their messages rather than leave them
+        # unacknowledged
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(self.scheduler.join()),
+                self.brain_config.shutdown_timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Gave up waiting for messages in progress. They will be"
+                " redelivered."
+            )
+
     def stop(self):
         """Stop the RabbitMQ consumer."""
+        if self.preferences_listener:
+            self.preferences_listener.cancel()
         if self.connection:
             self.connection.close()
             logger.info("RabbitMQ connection closed.")
@@ -119,7 +228,7 @@ class RazzlerBrain:
     def __del__(self):
         self.stop()
 
-    def replace_message_in_history(
+    async def replace_message_in_history(
         self,
         original_message: IncomingMessage,
         new_message: IncomingMessage,
@@ -127,7 +236,7 @@ class RazzlerBrain:
         """Given an original message and a new message, replace the original
         message in the message history with the new message.
 
-        Matches based on timestamp of the message."""
+        Matches based on timestamp and sender of the message."""
 
         logger.info(f"Replacing message with {new_message}")
 
@@ -136,38 +245,10 @@ class RazzlerBrain:
 
         chat = original_message.get_recipient()
 
-        msg_cache = f"message_history:{chat}"
-        message_history = self.redis_client.lrange(msg_cache, 0, -1)
-
-        # Get the index of the original message in the
-        # message history
-        logger.info(f"Message history length: {len(message_history)}")
-
-        for i, message_str in enumerate(message_history):
-            message = json.loads(message_str)
-
-            # If the message is of type IncomingMessage, instatiate it
-            if "envelope" in message:
-                message = IncomingMessage(**message)
-            else:
-                # If the message is not of type IncomingMessage, skip it
-                continue
-
-            # Try and parse the message for a timestamp
-            fetched_timestamp = message.envelope.timestamp
-            if fetched_timestamp == timestamp:
-                logger.info(
-                    "Found the original message - removing it "
-                    "from the message history"
-                )
-                logger.info(f"Original message: {message}")
-                # Remove the original message from the message history
-                self.redis_client.lset(
-                    msg_cache, i, new_message.model_dump_json()
-                )
-                return
-        else:
-            # Default to the front of the list
+        replaced = await replace_message(
+            self.async_redis_client, chat, original_message, new_message
+        )
+        if not replaced:
             logger.error("Original message not found in the message history")
             raise ValueError(
                 "Original message not found in the message history"
@@ -203,7 +284,7 @@ class RazzlerBrain:
         To whitelist a group, an admin has to send the following message in it:
             !whitelist
         """
-        wl_key = "whitelisted_groups"
+        wl_key = WHITELIST_KEY
 
         logger.info("Checking if this group needs to be whitelisted...")
         # Check that the message is a group message
@@ -217,23 +298,23 @@ class RazzlerBrain:
         # Check that this message is from an admin
         if message.envelope.sourceNumber not in self.brain_config.admins:
             logger.info("Cannot whitelist group; message is not from an admin")
-            return self.redis_client.sismember(wl_key, gid)
+            return await self.async_redis_client.sismember(wl_key, gid)
 
         # Check if the message content is the whitelist command
         if not message.envelope.dataMessage.message:
             logger.info("Message has no text content.")
-            return self.redis_client.sismember(wl_key, gid)
+            return await self.async_redis_client.sismember(wl_key, gid)
 
         msg = message.envelope.dataMessage.message
         if msg not in ["!whitelist", "!blacklist"]:
             # This is a normal message.
-            return self.redis_client.sismember(wl_key, gid)
+            return await self.async_redis_client.sismember(wl_key, gid)
 
         match msg:
             case "!whitelist":
                 # Whitelist the group
                 logger.info(f"Whitelisting group {gid}")
-                self.redis_client.sadd(wl_key, gid)
+                await self.async_redis_client.sadd(wl_key, gid)
                 with file_lock(self.whitelist_file) as f:
                     whitelisted_groups: List[str] = json.load(f)
                     whitelisted_groups.append(gid)
@@ -244,7 +325,7 @@ class RazzlerBrain:
             case "!blacklist":
                 # Blacklist the group
                 logger.info(f"Blacklisting group {gid}")
-                self.redis_client.srem(wl_key, gid)
+                await self.async_redis_client.srem(wl_key, gid)
                 with file_lock(self.whitelist_file) as f:
                     whitelisted_groups: List[str] = json.load(f)
                     whitelisted_groups.remove(gid)
@@ -255,16 +336,52 @@ class RazzlerBrain:
             case _:
                 raise ValueError(f"Invalid message content: {msg}")
 
+        # Let the consumers know, so they start or stop passing on messages
+        # from the group
+        await self.async_redis_client.publish(WHITELIST_UPDATED_CHANNEL, gid)
+
         await self.acknowledge_message(message)
         return msg == "!whitelist"
 
+    @staticmethod
+    def _chat_key(message: IncomingMessage) -> str:
+        """Identify the chat that a message belongs to, for ordering. This
+        doesn't need to be the recipient ID, just stable per chat, so it
+        avoids the phonebook."""
+        try:
+            return message.envelope.dataMessage.groupInfo.groupId
+        except AttributeError:
+            return message.envelope.source
+
+    async def _schedule_incoming_message(
+        self,
+        message: aio_pika.IncomingMessage,
+    ):
+        """Parse an incoming message from the queue, and hand it to the
+        scheduler. It is acknowledged once it has actually been processed."""
+        try:
+            # RabbitMQ messages are bytes, so we need to decode them
+            message_data = json.loads(message.body.decode())
+            # And parse into the IncomingMessage model
+            msg = IncomingMessage(**message_data)
+        except Exception as e:
+            logger.error(f"Could not parse incoming message: {e}")
+            await message.reject()
+            return
+
+        self.scheduler.submit(
+            self._chat_key(msg),
+            partial(self._process_incoming_message, message, msg),
+        )
+
     async def _process_incoming_message(
         self,
         message: aio_pika.IncomingMessage,
+        msg: IncomingMessage,
     ):
-        """For an incoming message, parse the incoming message JSON string into
-        an IncomingMessage object, then loop over the commands to see if any
+        """For a parsed incoming message, loop over the commands to see if any
         can handle the message. If a command can handle the message, run it.
+        The queue message is acknowledged once this is done.
 
         Note that all messages able to be handled by a command will be handled,
         so if a message *could* be handled by multiple commands, it will be.
@@ -272,11 +389,6 @@ class RazzlerBrain:
 
         logger.info("Processing incoming message...")
         async with message.process():
-
-            # RabbitMQ messages are bytes, so we need to decode them
-            message_data = json.loads(message.body.decode())
-            # And parse into the IncomingMessage model
-            msg = IncomingMessage(**message_data)
             logger.info(f"Received message: {msg}")
 
             # If the message is from a group, check that it's whitelisted
@@ -285,47 +397,123 @@ class RazzlerBrain:
                 logger.info(f"Skipping message from group {gid}")
                 return
 
+            # Look up the recipient off the event loop, so that commands'
+            # calls to get_recipient don't block it
+            await msg.resolve_recipient()
+
+            # Anything the commands look up about this message is shared
+            # between them, so e.g. the history is only fetched once
+            context = MessageContext(msg, self.redis_client, self.mongo_config)
+
             # Loop over commands. If a command can handle the message, run it.
             # Executes ALL commands able to handle a message, sequentially.
-            for command in self.commands:
-                if not command.can_handle(
-                    msg, self.redis_client, self.brain_config
+            # Commands whose triggers don't match the message are skipped.
+            for command in self.trigger_index.candidates(
+                msg, self.brain_config
+            ):
+                # Async handlers run on the event loop, with the asyncio
+                # Redis client. Synchronous ones run on the thread pool.
+                if isinstance(command, AsyncCommandHandler):
+                    redis_connection = self.async_redis_client
+                else:
+                    redis_connection = self.redis_client
+
+                if not await command.can_handle_async(
+                    msg,
+                    redis_connection,
+                    self.brain_config,
+                    self.executor,
+                    context,
                 ):
                     logger.debug(f"Skipping command {command}")
                     continue
 
                 logger.info(f"Handling message with {command}")
-                for response in command.handle(
-                    msg, self.redis_client, self.brain_config
-                ):
-                    # If the command returns None, there's nothing to do.
-                    # Go to the next response.
-                    if response is None:
-                        logger.debug("Command yielded None")
-                        continue
-
-                    logger.info(
-                        f"Command {command} produced message: {response}"
+                if command.llm_backed:
+                    await self._run_llm_command(
+                        command, msg, redis_connection, context
                     )
-
-                    # In the specific case of the command yielding an incoming
-                    # message, it is a replacement for the message that was
-                    # processed. We need to remove the original message from
-                    # the message history, if it's not been done already, then
-                    # push the new message into its place
-                    # NOTE: This is SLOW!
-                    if isinstance(response, IncomingMessage):
-                        self.replace_message_in_history(msg, response)
-
-                        # We don't publish the incoming message to the queue
-                        # so go to the next response
-                        continue
-
-                    # Publish the outgoing message to the queue
-                    await self.channel.default_exchange.publish(
-                        aio_pika.Message(
-                            body=response.model_dump_json().encode(),
-                            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                        ),
-                        routing_key="outgoing_messages",
+                else:
+                    await self._run_command(
+                        command, msg, redis_connection, context
                     )
+
+    async def _run_command(
+        self,
+        command: CommandHandler,
+        msg: IncomingMessage,
+        redis_connection: Union[redis.Redis, redis.asyncio.Redis],
+        context: MessageContext,
+    ):
+        """Run a command on a message, and deal with its responses."""
+        async for response in command.handle_async(
+            msg, redis_connection, self.brain_config, self.executor, context
+        ):
+            # If the command returns None, there's nothing to do.
+            # Go to the next response.
+            if response is None:
+                logger.debug("Command yielded None")
+                continue
+
+            logger.info(f"Command {command} produced message: {response}")
+
+            # In the specific case of the command yielding an incoming message,
+            # it is a replacement for the message that was processed. We need
+            # to remove the original message from the message history, if it's
+            # not been done already, then push the new message into its place
+            if isinstance(response, IncomingMessage):
+                await self.replace_message_in_history(msg, response)
+                context.invalidate_history()
+
+                # We don't publish the incoming message to the queue
+                # so go to the next response
+                continue
+
+            # Publish the outgoing message to the queue
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=response.model_dump_json().encode(),
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key="outgoing_messages",
+            )
+
+    async def _run_llm_command(
+        self,
+        command: CommandHandler,
+        msg: IncomingMessage,
+        redis_connection: Union[redis.Redis, redis.asyncio.Redis],
+        context: MessageContext,
+    ):
+        """Run a command that calls the LLM, if the sender's and the chat's
+        quotas allow it. The tokens it uses are counted against them.
+        Commands the sender didn't ask for only use the chat's quotas."""
+        user_id = msg.get_sender_id()
+        chat_id = msg.get_recipient()
+        prompted = not command.unprompted
+
+        exceeded = await self.quota.acquire(
+            self.async_redis_client, user_id, chat_id, prompted
+        )
+        if exceeded:
+            logger.info(
+                f"Not running {command} for {user_id} in {chat_id}: over the"
+                f" {exceeded} quota"
+            )
+            if prompted:
+                await self.acknowledge_message(msg, "⏳")
+            return
+
+        usage = TokenUsage()
+        token = current_token_usage.set(usage)
+        try:
+            await self._run_command(command, msg, redis_connection, context)
+        finally:
+            current_token_usage.reset(token)
+            await self.quota.record_tokens(
+                self.async_redis_client,
+                user_id,
+                chat_id,
+                usage.total,
+                prompted,
+            )
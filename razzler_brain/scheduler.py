@@ -0,0 +1,53 @@
+"""Schedules message processing so that messages from the same chat are
+handled strictly in the order they arrived, while messages from different
+chats are handled concurrently, up to a limit."""
+
+import asyncio
+from collections import deque
+from logging import getLogger
+from typing import Awaitable, Callable, Deque, Dict
+
+logger = getLogger(__name__)
+
+Job = Callable[[], Awaitable[None]]
+
+
+class ChatScheduler:
+    """Each chat gets a FIFO queue of jobs, drained by a single worker task
+    which only exists while the queue is non-empty. Workers share a semaphore,
+    so at most max_concurrency jobs (from different chats) run at once."""
+
+    def __init__(self, max_concurrency: int):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queues: Dict[str, Deque[Job]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+
+    def submit(self, chat_id: str, job: Job):
+        """Queue a job behind any other pending jobs for the same chat."""
+        self._queues.setdefault(chat_id, deque()).append(job)
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(
+                self._run_chat(chat_id)
+            )
+
+    async def _run_chat(self, chat_id: str):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                job = queue.popleft()
+                async with self._semaphore:
+                    try:
+                        await job()
+                    except Exception as e:
+                        logger.error(f"Error processing chat {chat_id}: {e}")
+        finally:
+            # No awaits between the final empty check and here, so a submit
+            # can't slip in unnoticed.
+            del self._workers[chat_id]
+            del self._queues[chat_id]
+
+    async def join(self):
+        """Wait until every queued job has finished."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values())
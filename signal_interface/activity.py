@@ -0,0 +1,85 @@
+"""How active each chat has been since the Razzler last spoke in it.
+
+For each chat, Redis holds:
+- chat_activity:<chat>, a sorted set of the messages received since the
+    Razzler last sent a message there, scored by their timestamps (ms)
+- chat_last_reply:<chat>, the time (ms) the Razzler last sent a message there
+
+The consumer adds messages as they arrive, and the producer clears the set
+when it sends a message, so counting the recent messages since the last
+reply is a single ZCOUNT, rather than a walk back through the history.
+"""
+
+import time
+
+import redis
+import redis.asyncio
+
+from utils.redis import get_script
+
+from .dataclasses import IncomingMessage
+from .history_store import incoming_record_id
+
+# Quiet chats are forgotten about after this long
+ACTIVITY_EXPIRY = 60 * 60 * 24 * 7
+
+
+def activity_key(chat: str) -> str:
+    return f"chat_activity:{chat}"
+
+
+def last_reply_key(chat: str) -> str:
+    return f"chat_last_reply:{chat}"
+
+
+# KEYS: activity, last reply. ARGV: earliest timestamp to count (ms)
+# Messages from before the last reply are never counted, in case they
+# arrived late.
+COUNT_SCRIPT = """
+local since = tonumber(ARGV[1])
+local last_reply = tonumber(redis.call('GET', KEYS[2]) or '0')
+if last_reply > since then
+    since = last_reply
+end
+return redis.call('ZCOUNT', KEYS[1], since, '+inf')
+"""
+
+
+async def record_activity(
+    client: redis.asyncio.Redis,
+    chat: str,
+    message: IncomingMessage,
+    max_length: int,
+):
+    """Count a message received in the chat. Only the most recent
+    max_length messages are kept."""
+    if not message.envelope.dataMessage:
+        # Don't count receipt messages
+        return
+
+    key = activity_key(chat)
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.zadd(
+            key, {incoming_record_id(message): message.envelope.timestamp}
+        )
+        pipe.zremrangebyrank(key, 0, -(max_length + 1))
+        pipe.expire(key, ACTIVITY_EXPIRY)
+        await pipe.execute()
+
+
+async def reset_activity(client: redis.asyncio.Redis, chat: str):
+    """Note that the Razzler has just sent a message to the chat."""
+    now = time.time_ns() // 1_000_000
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.delete(activity_key(chat))
+        pipe.set(last_reply_key(chat), now, ex=ACTIVITY_EXPIRY)
+        await pipe.execute()
+
+
+def count_activity(client: redis.Redis, chat: str, since: int) -> int:
+    """How many messages have been received in the chat since the Razzler
+    last sent one there, and no earlier than since (a timestamp in ms)."""
+    script = get_script(client, COUNT_SCRIPT)
+    return script(
+        keys=[activity_key(chat), last_reply_key(chat)], args=[since]
+    )
@@ -1,8 +1,9 @@
+import asyncio
 from typing import List, Literal, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
-from utils.local_storage import load_phonebook
+from utils.phonebook_store import phonebook_store
 
 MENTION_CHAR = "￼"
 
@@ -17,6 +18,38 @@ class SignalCredentials(BaseModel):
     admin_number: str
     # How many messages in the message history to preserve in the cache
     message_history_length: int = 100
+    # HTTP connection pool settings for talking to the signal API.
+    # Connections are kept alive between requests, up to http_pool_size at
+    # once.
+    http_pool_size: int = 32
+    http_keepalive_timeout: float = 60.0
+    # Timeouts, in seconds. The request timeout covers the whole request,
+    # including reading the response body.
+    http_request_timeout: float = 30.0
+    http_connect_timeout: float = 5.0
+    # Keepalive pings on the receive websocket, in seconds. If the signal
+    # service doesn't answer a ping within the timeout, the connection is
+    # treated as dead and re-established.
+    receive_ping_interval: Optional[float] = 20.0
+    receive_ping_timeout: Optional[float] = 20.0
+    # Bounds on the (jittered, exponential) delay between reconnect attempts
+    reconnect_min_delay: float = 1.0
+    reconnect_max_delay: float = 60.0
+    # How many attachments may be downloaded at once, and the largest
+    # attachment (in bytes) that we'll download. Larger ones are skipped.
+    max_concurrent_downloads: int = 4
+    max_attachment_size: Optional[int] = 100 * 1024 * 1024
+    # Large attachments can take a while, so downloads aren't subject to the
+    # request timeout. Instead, one is abandoned if the signal service sends
+    # nothing for this many seconds.
+    attachment_read_timeout: float = 30.0
+    # Incoming messages are published to RabbitMQ without waiting for each
+    # confirm. Once this many are unconfirmed, wait for the batch to be
+    # confirmed before publishing more.
+    publish_confirm_batch_size: int = 64
+    # Failed publishes are retried until they succeed, backing off up to
+    # this many seconds between attempts
+    publish_retry_max_delay: float = 30.0
 
 
 class ReceiptMessage(BaseModel):
@@ -119,16 +152,31 @@ class IncomingMessage(BaseModel):
     envelope: Envelope
     account: str
 
+    # The recipient is resolved once, on first use
+    _recipient: Optional[str] = PrivateAttr(default=None)
+
     def get_recipient(self) -> str:
         """Get the ID needed to target a return message. For phone numbers,
         this is the phone number. For groups, this is the internal ID of the
         group. *NOT* the ID attached to the message!
         """
+        if self._recipient is None:
+            self._recipient = self._resolve_recipient()
+        return self._recipient
+
+    async def resolve_recipient(self) -> str:
+        """As get_recipient, but if the group has to be looked up in the
+        phonebook database, that's done on a worker thread, so this is safe
+        to call on the event loop. Afterwards, get_recipient won't block."""
+        if self._recipient is None:
+            self._recipient = await asyncio.to_thread(self._resolve_recipient)
+        return self._recipient
+
+    def _resolve_recipient(self) -> str:
         if self.envelope.dataMessage:
             if self.envelope.dataMessage.groupInfo:
                 gid = self.envelope.dataMessage.groupInfo.groupId
-                phonebook = load_phonebook()
-                return phonebook.get_group_internal_id(gid)
+                return phonebook_store.resolve_group_internal_id(gid)
 
         return self.envelope.source
 
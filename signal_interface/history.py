@@ -0,0 +1,197 @@
+"""Encoding and decoding of the entries in a chat's message history.
+
+Each entry is stored as a small envelope which says which kind of message it
+holds, so it can be decoded in one go:
+
+    {"v": 1, "line": "Name [2024-06-01 12:00:00]: hello",
+     "tokens": {"cl100k_base": 12, "o200k_base": 12},
+     "kind": "incoming", "data": {...IncomingMessage...}}
+
+`line` is the message as it's shown to the LLM, and `tokens` is its length
+under each of TOKEN_ENCODINGS. These are worked out once, when the entry is
+written, so that building a chat history for the LLM doesn't have to
+re-render and re-tokenize every message. Messages that aren't shown to the
+LLM (e.g. reactions and receipts) have no line.
+
+Entries written before the envelope was introduced are bare messages. These
+are still understood, and identified by their fields, until they age out of
+the history.
+"""
+
+import json
+import time
+from datetime import datetime
+from logging import getLogger
+from typing import Annotated, Dict, Literal, Optional, Type, Union
+
+import pydantic
+import tiktoken
+from pydantic import BaseModel, Field, TypeAdapter
+
+from .dataclasses import IncomingMessage, OutgoingMessage, OutgoingReaction
+
+logger = getLogger(__name__)
+
+HISTORY_VERSION = 1
+
+# Token counts are stored for the encodings used by the chat models we use
+TOKEN_ENCODINGS = ("cl100k_base", "o200k_base")
+
+# The kinds of message stored in a chat's message history
+HistoryRecord = Union[IncomingMessage, OutgoingMessage, OutgoingReaction]
+
+
+class BaseHistoryEntry(BaseModel):
+    v: Literal[1] = HISTORY_VERSION
+    line: Optional[str] = None
+    tokens: Dict[str, int] = Field(default_factory=dict)
+
+
+class IncomingRecord(BaseHistoryEntry):
+    kind: Literal["incoming"] = "incoming"
+    data: IncomingMessage
+
+
+class OutgoingMessageRecord(BaseHistoryEntry):
+    kind: Literal["outgoing_message"] = "outgoing_message"
+    data: OutgoingMessage
+
+
+class OutgoingReactionRecord(BaseHistoryEntry):
+    kind: Literal["outgoing_reaction"] = "outgoing_reaction"
+    data: OutgoingReaction
+
+
+HistoryEntry = Union[
+    IncomingRecord, OutgoingMessageRecord, OutgoingReactionRecord
+]
+
+_entry_adapter = TypeAdapter(
+    Annotated[HistoryEntry, Field(discriminator="kind")]
+)
+
+_RECORD_TYPES: Dict[type, Type[BaseHistoryEntry]] = {
+    IncomingMessage: IncomingRecord,
+    OutgoingMessage: OutgoingMessageRecord,
+    OutgoingReaction: OutgoingReactionRecord,
+}
+
+
+def render_line(message: HistoryRecord) -> Optional[str]:
+    """Render a message as a line of the chat transcript given to the LLM,
+    or None if it shouldn't appear there."""
+    match message:
+        case IncomingMessage():
+            # Skips over things like reacts and other non-message events
+            data_message = message.envelope.dataMessage
+            if not data_message or not data_message.message:
+                return None
+
+            # Parse the UNIX timestamp (e.g. 1717075009) to a human-readable
+            # format. Irritatingly, the timestamp is in milliseconds
+            ts = message.envelope.timestamp / 1000
+            time_str = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+            return (
+                f"{message.envelope.sourceName} [{time_str}]:"
+                f" {data_message.message}"
+            )
+
+        case OutgoingMessage():
+            return f"Razzler: {message.message}"
+
+        case _:
+            return None
+
+
+# Loaded encodings, and when each encoding that failed to load last failed
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_encoding_failures: Dict[str, float] = {}
+
+# How long to wait, in seconds, before trying again to load an encoding
+ENCODING_RETRY_INTERVAL = 60 * 5
+
+
+def get_encoding(name: str) -> Optional[tiktoken.Encoding]:
+    """tiktoken downloads encodings on first use. If that fails, None is
+    returned, and we don't try again for every message; only once
+    ENCODING_RETRY_INTERVAL has passed."""
+    encoding = _encodings.get(name)
+    if encoding is not None:
+        return encoding
+
+    failed_at = _encoding_failures.get(name)
+    if (
+        failed_at is not None
+        and time.monotonic() - failed_at < ENCODING_RETRY_INTERVAL
+    ):
+        return None
+
+    try:
+        encoding = tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.error(f"Could not load the {name} encoding: {e}")
+        _encoding_failures[name] = time.monotonic()
+        return None
+
+    _encodings[name] = encoding
+    _encoding_failures.pop(name, None)
+    return encoding
+
+
+def encode_record(message: HistoryRecord) -> str:
+    """Wrap a message in a history envelope, ready to be stored."""
+    line = render_line(message)
+
+    # Token counts that can't be worked out here are left to the readers
+    tokens = {}
+    if line is not None:
+        for name in TOKEN_ENCODINGS:
+            encoding = get_encoding(name)
+            if encoding is not None:
+                tokens[name] = len(encoding.encode(line))
+
+    entry = _RECORD_TYPES[type(message)](
+        data=message, line=line, tokens=tokens
+    )
+    return entry.model_dump_json()
+
+
+def decode_entry(record: Union[str, bytes]) -> Optional[HistoryEntry]:
+    """Decode a history entry, or return None if it isn't recognised."""
+    if isinstance(record, str):
+        record = record.encode()
+
+    try:
+        # Envelopes are always dumped with the version first
+        if record.startswith(b'{"v":'):
+            return _entry_adapter.validate_json(record)
+        return _decode_legacy_record(record)
+
+    except (pydantic.ValidationError, ValueError) as e:
+        logger.error(f"Could not parse message: {record} ({e})")
+        return None
+
+
+def decode_record(record: Union[str, bytes]) -> Optional[HistoryRecord]:
+    """Decode a history entry to the message it holds, or return None if it
+    isn't recognised."""
+    entry = decode_entry(record)
+    return entry.data if entry is not None else None
+
+
+def _decode_legacy_record(record: bytes) -> HistoryEntry:
+    """Untagged entries are told apart by the fields they have. They have no
+    stored line or token counts, so the line is rendered here and the tokens
+    are left to the reader."""
+    msg_dict = json.loads(record)
+    if "envelope" in msg_dict:
+        message = IncomingMessage.model_validate(msg_dict)
+    elif "reaction" in msg_dict:
+        message = OutgoingReaction.model_validate(msg_dict)
+    else:
+        message = OutgoingMessage.model_validate(msg_dict)
+
+    return _RECORD_TYPES[type(message)](
+        data=message, line=render_line(message)
+    )
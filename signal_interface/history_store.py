@@ -0,0 +1,249 @@
+"""Storage for chats' message histories, in Redis.
+
+Each chat's history is kept under two keys:
+- message_records:<chat>, a hash of record ID -> encoded entry (see
+    history.py)
+- message_index:<chat>, a sorted set of the record IDs, scored by timestamp
+
+Incoming messages have IDs derived from their Signal timestamp and sender,
+so they can be found and rewritten (e.g. with an image description) in a
+single step. Reads walk the index from the most recent entry backwards, and
+the index is trimmed to a maximum length as entries are added, along with
+their records. Each of these is a Lua script, so is atomic.
+
+Histories used to be Redis lists under message_history:<chat>. A chat's list
+is migrated the first time its history is read, or a message is added to it.
+"""
+
+import secrets
+import time
+from logging import getLogger
+from typing import Iterator, Optional, Tuple
+
+import redis
+import redis.asyncio
+
+from utils.redis import get_script
+
+from .dataclasses import IncomingMessage, OutgoingReaction
+from .history import HistoryRecord, decode_record, encode_record
+
+logger = getLogger(__name__)
+
+
+def records_key(chat: str) -> str:
+    return f"message_records:{chat}"
+
+
+def index_key(chat: str) -> str:
+    return f"message_index:{chat}"
+
+
+def legacy_key(chat: str) -> str:
+    return f"message_history:{chat}"
+
+
+# KEYS: index, records, legacy list. ARGV: id, score, entry, max length
+# An empty score means "now": the Redis server's time, but always after the
+# latest entry already in the index.
+# Returns -1, without adding anything, if the legacy list needs migrating.
+APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return -1
+end
+local score = ARGV[2]
+if score == '' then
+    local now = redis.call('TIME')
+    score = now[1] * 1000 + math.floor(now[2] / 1000)
+    local latest = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if #latest > 0 and tonumber(latest[2]) >= score then
+        score = tonumber(latest[2]) + 1
+    end
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if excess > 0 then
+    local expired = redis.call('ZRANGE', KEYS[1], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    redis.call('HDEL', KEYS[2], unpack(expired))
+    return excess
+end
+return 0
+"""
+
+# KEYS: index, records. ARGV: start, stop (ranks, most recent first)
+# Entries that were trimmed since the index was read come back as nil.
+READ_SCRIPT = """
+local ids = redis.call('ZREVRANGE', KEYS[1], ARGV[1], ARGV[2])
+if #ids == 0 then
+    return {}
+end
+return redis.call('HMGET', KEYS[2], unpack(ids))
+"""
+
+# KEYS: records. ARGV: id, entry
+# Only replaces an existing entry; returns whether it did.
+REPLACE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# KEYS: index, records, legacy list. ARGV: (id, score, entry) triples
+# Does nothing if another process has already migrated the list.
+MIGRATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return 0
+end
+for i = 1, #ARGV, 3 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+end
+redis.call('DEL', KEYS[3])
+return 1
+"""
+
+
+def incoming_record_id(message: IncomingMessage) -> str:
+    """Signal timestamps are per sender, so the sender is included too."""
+    return f"in:{message.envelope.timestamp}:{message.envelope.sourceUuid}"
+
+
+def _outgoing_prefix(message: HistoryRecord) -> str:
+    return "react" if isinstance(message, OutgoingReaction) else "out"
+
+
+def record_id(message: HistoryRecord) -> Tuple[str, Optional[int]]:
+    """Return a record ID for the message, and the score to index it by.
+
+    Incoming messages are scored by their Signal timestamps. Our own messages
+    are scored by the append script, so that they always come after the
+    messages they respond to, even if the sender's clock is ahead of ours.
+    """
+    if isinstance(message, IncomingMessage):
+        return incoming_record_id(message), message.envelope.timestamp
+
+    now = time.time_ns() // 1_000_000
+    rid = f"{_outgoing_prefix(message)}:{now}:{secrets.token_hex(4)}"
+    return rid, None
+
+
+async def append_message(
+    client: redis.asyncio.Redis,
+    chat: str,
+    message: HistoryRecord,
+    max_length: int,
+):
+    """Add a message to the chat's history, dropping the oldest entries if
+    it's longer than max_length."""
+    rid, score = record_id(message)
+    score = "" if score is None else score
+    entry = encode_record(message)
+    append = get_script(client, APPEND_SCRIPT)
+    keys = [index_key(chat), records_key(chat), legacy_key(chat)]
+
+    result = await append(keys=keys, args=[rid, score, entry, max_length])
+    if result == -1:
+        await migrate_legacy_history(client, chat)
+        await append(keys=keys, args=[rid, score, entry, max_length])
+
+
+async def replace_message(
+    client: redis.asyncio.Redis,
+    chat: str,
+    original: IncomingMessage,
+    new: IncomingMessage,
+) -> bool:
+    """Overwrite the history entry for original with new, keeping its place.
+    Returns False if the original isn't in the history."""
+    replace = get_script(client, REPLACE_SCRIPT)
+    replaced = await replace(
+        keys=[records_key(chat)],
+        args=[incoming_record_id(original), encode_record(new)],
+    )
+    return bool(replaced)
+
+
+def iter_history(
+    client: redis.Redis,
+    chat: str,
+    first_page: int = 32,
+    max_page: int = 256,
+) -> Iterator[bytes]:
+    """Iterate over the encoded entries of a chat's history, most recent
+    first. Entries are fetched in pages which double in size, up to
+    max_page, so readers that stop early only pay for what they read. The
+    pages are separate reads, so a page may repeat entries from the last one
+    if messages are added part way through."""
+    read = get_script(client, READ_SCRIPT)
+    keys = [index_key(chat), records_key(chat)]
+
+    start = 0
+    page = first_page
+    while True:
+        values = read(keys=keys, args=[start, start + page - 1])
+        if start == 0 and not values and client.exists(legacy_key(chat)):
+            migrate_legacy_history_sync(client, chat)
+            values = read(keys=keys, args=[start, start + page - 1])
+
+        yield from (value for value in values if value is not None)
+
+        if len(values) < page:
+            return
+
+        start += page
+        page = min(page * 2, max_page)
+
+
+def _migration_args(chat: str, entries: list) -> list:
+    """The MIGRATE_SCRIPT arguments for a legacy list's entries.
+
+    The list only records the order of the messages, and outgoing messages
+    have no timestamp of their own, so these are scored just after the
+    message before them. IDs are derived from the list contents, so if two
+    processes migrate the same chat at once, they write the same records.
+    """
+    logger.info(f"Migrating {len(entries)} history entries for chat {chat}")
+
+    args = []
+    last_score = 0
+    # The list is most recent first
+    for i, entry in enumerate(reversed(entries)):
+        message = decode_record(entry)
+        if message is None:
+            continue
+
+        if isinstance(message, IncomingMessage):
+            rid = incoming_record_id(message)
+            score = max(message.envelope.timestamp, last_score + 1)
+        else:
+            score = last_score + 1
+            rid = f"{_outgoing_prefix(message)}:{score}:legacy{i}"
+
+        args += [rid, score, encode_record(message)]
+        last_score = score
+
+    return args
+
+
+async def migrate_legacy_history(client: redis.asyncio.Redis, chat: str):
+    """Move a chat's history from the old list into the hash and index."""
+    entries = await client.lrange(legacy_key(chat), 0, -1)
+    migrate = get_script(client, MIGRATE_SCRIPT)
+    await migrate(
+        keys=[index_key(chat), records_key(chat), legacy_key(chat)],
+        args=_migration_args(chat, entries),
+    )
+
+
+def migrate_legacy_history_sync(client: redis.Redis, chat: str):
+    """migrate_legacy_history, for the brain's synchronous reads."""
+    entries = client.lrange(legacy_key(chat), 0, -1)
+    migrate = get_script(client, MIGRATE_SCRIPT)
+    migrate(
+        keys=[index_key(chat), records_key(chat), legacy_key(chat)],
+        args=_migration_args(chat, entries),
+    )
@@ -1,31 +1,183 @@
-from typing import Any, AsyncGenerator, Dict
+import asyncio
+import json
+import random
+from logging import getLogger
+from typing import IO, Any, AsyncGenerator, Dict, List, Optional
 
 import aiohttp
 import websockets
 
+from .dataclasses import SignalCredentials
+
+logger = getLogger(__name__)
+
 
 class SignalAPI:
+    """Thin async client for the signal-cli REST API.
+
+    All HTTP calls share a single keep-alive connection pool, which is created
+    lazily on first use (so that the client can be constructed before the
+    event loop exists, e.g. before forking worker processes). Call `close`
+    when finished with the client to release the pooled connections.
+    """
+
+    _session: Optional[aiohttp.ClientSession]
+
     def __init__(
         self,
         signal_service: str,
         phone_number: str,
+        pool_size: int = 32,
+        keepalive_timeout: float = 60.0,
+        request_timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        ping_interval: Optional[float] = 20.0,
+        ping_timeout: Optional[float] = 20.0,
+        reconnect_min_delay: float = 1.0,
+        reconnect_max_delay: float = 60.0,
+        attachment_read_timeout: float = 30.0,
     ):
         self.signal_service = signal_service
         self.phone_number = phone_number
 
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.connect_timeout = connect_timeout
+        self.attachment_read_timeout = attachment_read_timeout
+
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+
+        self._session = None
+
+    @classmethod
+    def from_config(cls, signal_info: SignalCredentials) -> "SignalAPI":
+        """Create a client with the settings in the signal config."""
+        return cls(
+            signal_info.signal_service,
+            signal_info.phone_number,
+            pool_size=signal_info.http_pool_size,
+            keepalive_timeout=signal_info.http_keepalive_timeout,
+            request_timeout=signal_info.http_request_timeout,
+            connect_timeout=signal_info.http_connect_timeout,
+            ping_interval=signal_info.receive_ping_interval,
+            ping_timeout=signal_info.receive_ping_timeout,
+            reconnect_min_delay=signal_info.reconnect_min_delay,
+            reconnect_max_delay=signal_info.reconnect_max_delay,
+            attachment_read_timeout=signal_info.attachment_read_timeout,
+        )
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared HTTP session. Re-created if it has been closed."""
+        if self._session is None or self._session.closed:
+            logger.debug(
+                f"Opening HTTP connection pool to {self.signal_service}"
+            )
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.request_timeout,
+                connect=self.connect_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout
+            )
+        return self._session
+
+    async def close(self):
+        """Close the shared HTTP session, and its pooled connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.debug("Closed HTTP connection pool")
+        self._session = None
+
     async def get_groups(self) -> Dict[str, Any]:
         uri = self._get_groups_uri()
-        async with aiohttp.ClientSession() as session:
-            resp = await session.get(uri)
+        async with self.session.get(uri) as resp:
             resp.raise_for_status()
             return await resp.json()
 
-    async def receive(self) -> AsyncGenerator[Any, Any]:
+    async def receive_pending(self) -> List[Dict[str, Any]]:
+        """Fetch the messages that the signal service queued up while we
+        weren't listening. The websocket only streams new messages, but the
+        HTTP endpoint returns everything that hasn't been acknowledged yet."""
+        uri = self._receive_rest_uri()
+        async with self.session.get(uri) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def _drain_backlog(self) -> AsyncGenerator[str, Any]:
+        """Yield any backlogged messages, serialised the same way as the
+        websocket delivers them. Failures are logged, but not raised, since
+        the websocket is still worth connecting to."""
+        try:
+            backlog = await self.receive_pending()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Failed to drain the receive backlog: {e}")
+            return
+
+        if backlog:
+            logger.info(f"Draining {len(backlog)} backlogged messages")
+        for message in backlog:
+            yield json.dumps(message)
+
+    def _reconnect_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter, so that several consumers
+        don't all hammer the signal service at the same moment."""
+        ceiling = min(
+            self.reconnect_max_delay,
+            self.reconnect_min_delay * 2**attempt,
+        )
+        return random.uniform(self.reconnect_min_delay, ceiling)
+
+    async def receive(self) -> AsyncGenerator[str, Any]:
+        """Yield raw incoming messages, forever.
+
+        On every (re)connect, the HTTP backlog is drained before the websocket
+        is streamed. If the websocket closes, or the peer stops answering
+        pings, we reconnect with a jittered exponential backoff.
+        """
         uri = self._receive_ws_uri()
-        self.connection = websockets.connect(uri, ping_interval=None)
-        async with self.connection as websocket:
-            async for raw_message in websocket:
-                yield raw_message
+        attempt = 0
+
+        while True:
+            try:
+                async for raw_message in self._drain_backlog():
+                    yield raw_message
+
+                async with websockets.connect(
+                    uri,
+                    ping_interval=self.ping_interval,
+                    ping_timeout=self.ping_timeout,
+                    open_timeout=self.connect_timeout,
+                ) as websocket:
+                    logger.info("Connected to the signal receive websocket")
+                    attempt = 0
+                    async for raw_message in websocket:
+                        yield raw_message
+
+                logger.warning("Signal receive websocket closed")
+            except (
+                websockets.exceptions.WebSocketException,
+                OSError,
+                asyncio.TimeoutError,
+            ) as e:
+                logger.error(f"Signal receive websocket failed: {e}")
+
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            logger.info(
+                f"Reconnecting to the signal receive websocket in {delay:.1f}s"
+                f" (attempt {attempt})"
+            )
+            await asyncio.sleep(delay)
 
     async def send(
         self, receiver: str, message: str, base64_attachments: list = None
@@ -39,8 +191,7 @@ class SignalAPI:
             "number": self.phone_number,
             "recipients": [receiver],
         }
-        async with aiohttp.ClientSession() as session:
-            resp = await session.post(uri, json=payload)
+        async with self.session.post(uri, json=payload) as resp:
             resp.raise_for_status()
             return resp
 
@@ -60,8 +211,7 @@ class SignalAPI:
             "target_author": target_author,
             "timestamp": timestamp,
         }
-        async with aiohttp.ClientSession() as session:
-            resp = await session.post(uri, json=payload)
+        async with self.session.post(uri, json=payload) as resp:
             resp.raise_for_status()
             return resp
 
@@ -71,8 +221,7 @@ class SignalAPI:
             "recipient": receiver,
         }
         try:
-            async with aiohttp.ClientSession() as session:
-                resp = await session.put(uri, json=payload)
+            async with self.session.put(uri, json=payload) as resp:
                 resp.raise_for_status()
                 return resp
         except (
@@ -87,8 +236,7 @@ class SignalAPI:
             "recipient": receiver,
         }
         try:
-            async with aiohttp.ClientSession() as session:
-                resp = await session.delete(uri, json=payload)
+            async with self.session.delete(uri, json=payload) as resp:
                 resp.raise_for_status()
                 return resp
         except (
@@ -97,14 +245,53 @@ class SignalAPI:
         ):
             raise StopTypingError
 
-    async def download_attachment(self, attachment_id: str) -> bytes:
-        """Returns the base64 encoded attachment."""
+    async def download_attachment(
+        self,
+        attachment_id: str,
+        dest: IO[bytes],
+        max_size: Optional[int] = None,
+        chunk_size: int = 64 * 1024,
+    ) -> int:
+        """Stream an attachment into the given binary file object, in chunks,
+        so that large files never have to be held in memory.
+
+        Raises AttachmentTooLargeError if the attachment is bigger than
+        max_size bytes. In that case, dest may contain a partial download.
+
+        Returns the number of bytes written.
+        """
         uri = self._download_attachment_uri(attachment_id)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(uri) as resp:
-                resp.raise_for_status()
-                # The API returns the base64 encoded attachment
-                return await resp.read()
+        # The session's total timeout would cut off large downloads part way
+        # through, so only a stalled download is given up on
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=self.connect_timeout,
+            sock_read=self.attachment_read_timeout,
+        )
+        async with self.session.get(uri, timeout=timeout) as resp:
+            resp.raise_for_status()
+
+            # Bail early if the server tells us up front that it's too big
+            if (
+                max_size is not None
+                and resp.content_length is not None
+                and resp.content_length > max_size
+            ):
+                raise AttachmentTooLargeError(
+                    f"Attachment {attachment_id} is {resp.content_length}"
+                    f" bytes (max {max_size})"
+                )
+
+            size = 0
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise AttachmentTooLargeError(
+                        f"Attachment {attachment_id} exceeded {max_size} bytes"
+                    )
+                dest.write(chunk)
+
+            return size
 
     def _receive_ws_uri(self):
         """Hardcoded to ignore stories, get attachments, and send read
@@ -116,6 +303,16 @@ class SignalAPI:
             "&ignore_stories=true"
         )
 
+    def _receive_rest_uri(self):
+        """The HTTP twin of the websocket endpoint, which returns a list of
+        all unacknowledged messages."""
+        return (
+            f"http://{self.signal_service}/v1/receive/{self.phone_number}"
+            "?send_read_receipts=true"
+            "&ignore_attachments=false"
+            "&ignore_stories=true"
+        )
+
     def _send_rest_uri(self):
         return f"http://{self.signal_service}/v2/send"
 
@@ -157,3 +354,7 @@ class StopTypingError(TypingError):
 
 class ReactionError(Exception):
     pass
+
+
+class AttachmentTooLargeError(Exception):
+    pass
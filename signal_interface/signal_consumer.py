@@ -12,14 +12,15 @@ import asyncio
 import json
 import re
 from logging import getLogger
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import aio_pika
-import redis
+import redis.asyncio
 
-from utils.phonebook import PhoneBook
-from utils.local_storage import file_lock, load_phonebook
-from utils.redis import RedisCredentials
+from utils.local_storage import atomic_write
+from utils.phonebook import Contact, Group, PhoneBook
+from utils.phonebook_store import load_phonebook, phonebook_store
+from utils.redis import RedisCredentials, claim_key, get_async_redis_client
 
 from .dataclasses import (
     Attachment,
@@ -30,7 +31,10 @@ from .dataclasses import (
     QuoteMessage,
     SignalCredentials,
 )
-from .signal_api import SignalAPI
+from .activity import record_activity
+from .history_store import append_message
+from .signal_api import AttachmentTooLargeError, SignalAPI
+from .whitelist import WhitelistCache
 
 logger = getLogger(__name__)
 
@@ -48,34 +52,46 @@ class SignalConsumer:
     phonebook: PhoneBook
     api_client: SignalAPI
     signal_info: SignalCredentials
-    redis_client: redis.Redis
+    redis_client: redis.asyncio.Redis
     event_loop: asyncio.AbstractEventLoop
     rabbit_config: dict
+    channel: aio_pika.abc.AbstractRobustChannel
 
     def __init__(
         self,
         signal_info: SignalCredentials,
         redis_config: RedisCredentials,
         rabbit_config: dict,
+        admins: Optional[List[str]] = None,
     ):
         logger.info("Initializing SignalConsumer...")
-        self.api_client = SignalAPI(
-            signal_info.signal_service, signal_info.phone_number
-        )
+        self.api_client = SignalAPI.from_config(signal_info)
         self.signal_info = signal_info
         self.rabbit_config = rabbit_config
-        self.redis_client = redis.Redis(**redis_config.model_dump())
+        self.redis_client = get_async_redis_client(redis_config)
+
+        # Messages from groups that aren't whitelisted are dropped on
+        # arrival, unless they're an admin whitelisting the group
+        if admins is None:
+            admins = [signal_info.admin_number]
+        self.admins = admins
+        self.whitelist = WhitelistCache()
+        self.whitelist_listener = None
+
+        # Limits how many attachments are downloaded at once
+        self.download_semaphore = asyncio.Semaphore(
+            signal_info.max_concurrent_downloads
+        )
 
-        # RabbitMQ connection
+        # RabbitMQ connection, and the long-lived channel we publish on
         self.connection = None
+        self.channel = None
+        # Publishes that the broker has not yet confirmed, in the order they
+        # were made
+        self._unconfirmed: List[Tuple[bytes, asyncio.Task]] = []
 
-        # Set up the phonebook
-        if load_phonebook() == PhoneBook():
-            with file_lock("phonebook.json") as f:
-                f.seek(0)
-                f.write(PhoneBook().model_dump_json())
-                f.truncate()
-
+        # Keep a local copy of the phonebook. Changes are written through to
+        # the phonebook store one record at a time.
         self.phonebook = load_phonebook()
 
         logger.info("SignalConsumer initialized.")
@@ -88,17 +104,26 @@ class SignalConsumer:
         Fetches from signal a list of currently participating groups, and adds
         them to the phonebook."""
         groups = await self.api_client.get_groups()
-        with file_lock("phonebook.json") as f:
-            phonebook = PhoneBook(**json.load(f))
-            for group in groups:
-                logger.info(f"Adding group to phonebook: {group}")
-                phonebook.add_group(group)
-            pb_string = phonebook.model_dump_json()
-
-            # Write the updated phonebook back to the file
-            f.seek(0)
-            f.write(pb_string)
-            f.truncate()
+
+        updated_groups: List[Group] = []
+        updated_contacts: List[Contact] = []
+        for group in groups:
+            logger.info(f"Adding group to phonebook: {group}")
+            self.phonebook.add_group(group)
+            updated_groups.append(self.phonebook.groups[group["id"]])
+            updated_contacts.extend(
+                self.phonebook.get_contact(member)
+                for member in group["members"]
+            )
+
+        # Only the groups, and their members, are written back. The write
+        # can wait on other processes, so it's kept off the event loop. It
+        # gets copies, since the phonebook may change in the meantime.
+        await asyncio.to_thread(
+            phonebook_store.upsert,
+            [contact.model_copy() for contact in updated_contacts],
+            [group.model_copy() for group in updated_groups],
+        )
 
     def get_rabbitmq_connection(self):
         return aio_pika.connect_robust(**self.rabbit_config)
@@ -109,58 +134,142 @@ class SignalConsumer:
         logger.info("Initializing RabbitMQ connection...")
         self.connection = await self.get_rabbitmq_connection()
 
-        async with self.connection:
-            channel = await self.connection.channel()  # Get channel
-            await channel.set_qos(prefetch_count=1)
-            await channel.declare_queue("incoming_messages", durable=True)
+        # This channel stays open for the lifetime of the consumer. Being
+        # robust, it is re-opened automatically if the connection drops.
+        self.channel = await self.connection.channel(publisher_confirms=True)
+        await self.channel.declare_queue("incoming_messages", durable=True)
         logger.info("Connected to RabbitMQ and declared the queues.")
 
     async def start(self):
         logger.info(
             f"Starting SignalConsumer for {self.signal_info.phone_number}..."
         )
-        await self._init_mq()
-        await self.update_groups()
-        await self.listen()
+        self.whitelist_listener = asyncio.create_task(
+            self.whitelist.listen(self.redis_client)
+        )
+        try:
+            await self._init_mq()
+            await self.update_groups()
+            await self.listen()
+        finally:
+            self.whitelist_listener.cancel()
+            await self.api_client.close()
 
     async def stop(self):
+        if self.whitelist_listener:
+            self.whitelist_listener.cancel()
+        await self._wait_for_confirms()
+        await self.api_client.close()
+        await self.redis_client.aclose()
         await self.connection.close()
         logger.info("Connection closed. Stopped SignalConsumer")
 
     async def listen(self):
-        """Check for new messages to add to the message queue."""
+        """Check for new messages to add to the message queue.
+
+        The API client handles reconnecting, so this runs until cancelled. A
+        message that fails to process is logged and dropped, rather than
+        taking down the listener."""
         async for raw_message in self.api_client.receive():
-            message = json.loads(raw_message)
+            try:
+                message = json.loads(raw_message)
+
+                logger.debug(f"Signal API yielded the message: {message}")
+                # Add a queue item to process the incoming message
+                await self._process_incoming(message)
+            except Exception as e:
+                logger.error(f"Error processing incoming message: {e}")
+
+    async def _publish_body(self, body: bytes):
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(
+                body=body,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key="incoming_messages",
+        )
+
+    def _start_publish(self, body: bytes):
+        """Start publishing a message, without waiting for the broker to
+        confirm it."""
+        task = asyncio.create_task(self._publish_body(body))
+        self._unconfirmed.append((body, task))
+
+    def _publish_failed(self) -> bool:
+        """Has any outstanding publish already failed?"""
+        return any(
+            task.done() and (task.cancelled() or task.exception())
+            for _, task in self._unconfirmed
+        )
 
-            logger.debug(f"Signal API yielded the message: {message}")
-            # Add a queue item to process the incoming message
-            await self._process_incoming(message)
+    async def _wait_for_confirms(self):
+        """Wait until the broker has confirmed every message published so far.
+
+        If a publish failed, it and every message published after it are sent
+        again, in their original order, after a back off. This repeats until
+        they're all confirmed, and nothing new is published in the meantime,
+        so messages are never lost or reordered. (If the broker rejected a
+        message but accepted some after it, those are sent twice.)
+        """
+        attempt = 0
+        while self._unconfirmed:
+            batch, self._unconfirmed = self._unconfirmed, []
+            results = await asyncio.gather(
+                *(task for _, task in batch), return_exceptions=True
+            )
+            failed = next(
+                (
+                    i
+                    for i, result in enumerate(results)
+                    if isinstance(result, BaseException)
+                ),
+                None,
+            )
+            if failed is None:
+                return
+
+            attempt += 1
+            delay = min(
+                0.5 * 2 ** (attempt - 1),
+                self.signal_info.publish_retry_max_delay,
+            )
+            logger.error(
+                f"Publish failed ({results[failed]}). Re-sending"
+                f" {len(batch) - failed} messages in {delay:.1f} seconds"
+            )
+            await asyncio.sleep(delay)
+            for body, _ in batch[failed:]:
+                self._start_publish(body)
 
     async def _publish_message(self, msg: IncomingMessage):
-        """Serialize and publish messages to RabbitMQ."""
+        """Serialize and publish messages to RabbitMQ.
+
+        Publishes are pipelined on a single channel: we don't wait for each
+        one to be confirmed. Once `publish_confirm_batch_size` publishes are in
+        flight, we wait for the broker to confirm the whole batch before
+        accepting more. If a publish has failed, it's re-sent before this
+        message, to keep each chat's messages in order."""
         logger.info(f"Publishing an incoming message to RabbitMQ: {msg}")
         serialized_message = msg.model_dump_json()
 
-        # Reconnect if the connection is closed
-        if self.connection.is_closed:
-            self.connection = await self.get_rabbitmq_connection()
-
-        async with self.connection as conn:
-            async with conn.channel() as channel:
-                await channel.default_exchange.publish(
-                    aio_pika.Message(
-                        body=serialized_message.encode(),
-                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                    ),
-                    routing_key="incoming_messages",
-                )
-                logger.info(
-                    "Added message to the processing queue: Timestamp"
-                    f" {msg.envelope.timestamp} from"
-                    f" {msg.envelope.sourceNumber}"
-                )
+        if self._publish_failed():
+            await self._wait_for_confirms()
 
-    def update_contact_info(self, msg: IncomingMessage):
+        self._start_publish(serialized_message.encode())
+        logger.info(
+            "Added message to the processing queue: Timestamp"
+            f" {msg.envelope.timestamp} from"
+            f" {msg.envelope.sourceNumber}"
+        )
+
+        batch_size = self.signal_info.publish_confirm_batch_size
+        if len(self._unconfirmed) >= batch_size:
+            logger.debug(
+                f"Waiting for {len(self._unconfirmed)} publish confirms..."
+            )
+            await self._wait_for_confirms()
+
+    async def update_contact_info(self, msg: IncomingMessage):
         """Incoming messages contain data on contacts. This function updates
         the phonebook with the contact information."""
 
@@ -174,66 +283,93 @@ class SignalConsumer:
         )
 
         if is_updated:
-            # If it is, then get a lock on the file and update the phonebook
-            # properly
-            with file_lock("phonebook.json") as f:
-                phonebook = PhoneBook(**json.load(f))
-                phonebook.update_contact(
-                    msg.envelope.sourceUuid,
-                    msg.envelope.sourceNumber,
-                    msg.envelope.sourceName,
-                )
-
-                # Write the updated phonebook back to the file
-                f.seek(0)
-                f.write(phonebook.model_dump_json())
-                f.truncate()
-
-            self.phonebook = phonebook
+            # If it is, then write just that contact through to the store
+            contact = self.phonebook.get_contact(
+                msg.envelope.sourceUuid, msg.envelope.sourceNumber
+            )
+            await asyncio.to_thread(
+                phonebook_store.upsert, contacts=[contact.model_copy()]
+            )
             logger.info(f"Updated phonebook contact: {msg.envelope.source}")
 
-    async def download_attachments(
-        self, data: Union[DataMessage, QuoteMessage]
+    async def download_attachment(
+        self, attachment: Union[Attachment, QuoteAttachment]
     ):
-        """Download attachments from the message, to local storage."""
+        """Stream a single attachment to local storage, and point its data
+        field at the local file. Attachments that are too large, or that fail
+        to download, are left without data."""
 
-        for attachment in data.attachments:
+        if isinstance(attachment, Attachment):
+            identifier = attachment.id
+        elif isinstance(attachment, QuoteAttachment):
+            identifier = attachment.thumbnail.id
+        else:
+            raise ValueError(f"Attachment type {type(attachment)} not valid.")
 
-            if isinstance(attachment, Attachment):
-                identifier = attachment.id
-            elif isinstance(attachment, QuoteAttachment):
-                identifier = attachment.thumbnail.id
-            else:
-                raise ValueError(
-                    f"Attachment type {type(attachment)} not valid."
-                )
+        local_filename = f"attachments/{identifier}"
 
+        async with self.download_semaphore:
             logger.info(f"Downloading attachment: {identifier}")
-            attachment_bytes = await self.api_client.download_attachment(
-                identifier
-            )
+            # Attachment IDs are unique, so nothing else writes this file and
+            # it needn't be locked. If the download fails, atomic_write
+            # discards the partial file.
+            try:
+                with atomic_write(local_filename, "wb") as f:
+                    size = await self.api_client.download_attachment(
+                        identifier,
+                        f,
+                        max_size=self.signal_info.max_attachment_size,
+                    )
+            except AttachmentTooLargeError as e:
+                logger.warning(f"Skipping attachment: {e}")
+                return
+            except Exception as e:
+                logger.error(
+                    f"Failed to download attachment {identifier}: {e}"
+                )
+                return
 
-            local_filename = f"attachments/{identifier}"
-            with file_lock(local_filename, "wb") as f:
-                f.write(attachment_bytes)
+        attachment.data = local_filename
+        logger.debug(f"Downloaded attachment: {identifier} ({size} bytes)")
 
-            # convert the bytes to b64 for storage
-            attachment.data = local_filename
-            logger.debug(f"Downloaded attachment: {identifier}")
+    async def download_attachments(
+        self, *data: Union[DataMessage, QuoteMessage]
+    ):
+        """Download the attachments of the given messages to local storage,
+        concurrently. At most `max_concurrent_downloads` run at once."""
+        await asyncio.gather(
+            *[
+                self.download_attachment(attachment)
+                for message in data
+                for attachment in message.attachments
+            ]
+        )
 
-    def add_message_to_history(self, msg: IncomingMessage):
+    async def add_message_to_history(self, msg: IncomingMessage):
         """Add the message to the message history redis cache.
 
-        The key is formatted like this: message_history:<recipient>
-        where recipient is the phone number of the recipient of the message,
-        or the group ID if it is a group message.
+        The history is kept per recipient, which is the phone number of the
+        recipient of the message, or the group ID if it is a group message.
+        See history_store for how it's stored.
         """
 
-        msg_cache = f"message_history:{msg.get_recipient()}"
-        self.redis_client.lpush(msg_cache, msg.model_dump_json())
+        # Finding a group's recipient ID may need the phonebook database
+        recipient = await msg.resolve_recipient()
+
         # Ensure the message history cache doesn't grow too large
-        self.redis_client.ltrim(
-            msg_cache, 0, self.signal_info.message_history_length
+        await append_message(
+            self.redis_client,
+            recipient,
+            msg,
+            self.signal_info.message_history_length,
+        )
+
+        # Keep count of messages since the Razzler last spoke in the chat
+        await record_activity(
+            self.redis_client,
+            recipient,
+            msg,
+            self.signal_info.message_history_length,
         )
 
     def parse_mentions(self, message: str, mentions: List[Mention]):
@@ -269,20 +405,27 @@ class SignalConsumer:
             return
         logger.debug("Parsed incoming message payload")
 
+        # Drop messages from groups we don't serve before doing any work on
+        # them. The brain handles whitelisting.
+        if not await self.whitelist.allows(
+            self.redis_client, msg, self.admins
+        ):
+            logger.debug("Ignoring message from a non-whitelisted group")
+            return
+
         # Deduplicate messages using the timestamp as a unique identifier.
-        # If we've already processed a message with this timestamp then skip it.
+        # Claiming the key is atomic, so if several consumers see the same
+        # message, only one of them will process it. Expire after 1 day to
+        # avoid unbounded growth.
         cache_key = f"processed_message:{msg.envelope.timestamp}"
-        if self.redis_client.get(cache_key):
+        if not await claim_key(self.redis_client, cache_key, 60 * 60 * 24):
             logger.info(
                 "Skipping already processed message with timestamp "
                 f"{msg.envelope.timestamp}"
             )
             return
-        # Mark the message as processed. Expire after 1 day to avoid unbounded
-        # growth.
-        self.redis_client.set(cache_key, 1, ex=60 * 60 * 24)
 
-        self.update_contact_info(msg)
+        await self.update_contact_info(msg)
 
         # Ignore messages sent by the bot itself. Sometimes Signal will echo
         # back messages that we've just sent (sync messages), which can cause
@@ -315,10 +458,12 @@ class SignalConsumer:
                     logger.info("New group detected. Updating phonebook.")
                     await self.update_groups()
 
-            # If it has an attachement, we need to download it
+            # Messages (and their quotes) may carry attachments. These are
+            # all fetched together, once we know what we need.
+            with_attachments: List[Union[DataMessage, QuoteMessage]] = []
             if data.attachments:
                 logger.info("Message has attachments.")
-                await self.download_attachments(data)
+                with_attachments.append(data)
 
             # Parse mentions in the message body, into contact names.
             data.message = self.parse_mentions(data.message, data.mentions)
@@ -340,13 +485,13 @@ class SignalConsumer:
                 # Quotes can have attachments too
                 if quote.attachments:
                     logger.info("Quote has attachments.")
-                    logger.info(
-                        f"Downloading attachments for quote: {message}"
-                    )
-                    await self.download_attachments(quote)
+                    with_attachments.append(quote)
+
+            if with_attachments:
+                await self.download_attachments(*with_attachments)
 
             # Place the message in the message history list
-            self.add_message_to_history(msg)
+            await self.add_message_to_history(msg)
 
         # Add the message to the processing queue
         await self._publish_message(msg)
@@ -4,11 +4,12 @@ from logging import getLogger
 from typing import List, Optional
 
 import aio_pika
-import redis
 
-from utils.redis import RedisCredentials
+from utils.redis import RedisCredentials, get_async_redis_client
 
+from .activity import reset_activity
 from .dataclasses import OutgoingMessage, OutgoingReaction, SignalCredentials
+from .history_store import append_message
 from .signal_api import SignalAPI
 
 logger = getLogger(__name__)
@@ -29,13 +30,11 @@ class SignalProducer:
     ):
         logger.info("Initializing SignalProducer...")
         self.signal_info = signal_api_config
-        self.api_client = SignalAPI(
-            signal_api_config.signal_service, signal_api_config.phone_number
-        )
+        self.api_client = SignalAPI.from_config(signal_api_config)
         self.rabbit_config = rabbit_config
         self.connection = None
 
-        self.redis_client = redis.Redis(**redis_config.model_dump())
+        self.redis_client = get_async_redis_client(redis_config)
 
     def __del__(self):
         self.stop()
@@ -55,11 +54,16 @@ class SignalProducer:
 
     async def start(self):
         logger.info("Starting SignalProducer...")
-        await self._init_mq()
-        await self.consume_messages()
+        try:
+            await self._init_mq()
+            await self.consume_messages()
+        finally:
+            await self.api_client.close()
 
     async def stop(self):
         logger.info("Stopping SignalProducer...")
+        await self.api_client.close()
+        await self.redis_client.aclose()
         await self.connection.close()
         logger.info("SignalProducer stopped.")
 
@@ -103,13 +107,15 @@ class SignalProducer:
         )
         logger.info("Message sent successfully.")
 
-        # Place the message in the message history list
-        cache_key = f"message_history:{message.recipient}"
-        self.redis_client.lpush(cache_key, message.model_dump_json())
+        # Place the message in the message history
         # Ensure the message history cache doesn't grow too large
-        self.redis_client.ltrim(
-            cache_key, 0, self.signal_info.message_history_length
+        await append_message(
+            self.redis_client,
+            message.recipient,
+            message,
+            self.signal_info.message_history_length,
         )
+        await reset_activity(self.redis_client, message.recipient)
 
     async def _process_outgoing_reaction(self, reaction: OutgoingReaction):
         """Process and send outgoing reactions using the Signal API."""
@@ -0,0 +1,78 @@
+"""Which group chats the Razzler will talk in.
+
+The whitelisted group IDs are kept in the whitelisted_groups Redis set. The
+brain changes it when an admin sends !whitelist or !blacklist in a group, and
+announces the change on WHITELIST_UPDATED_CHANNEL. Consumers keep a local
+copy of the set, reloaded whenever a change is announced, so that they can
+drop messages from other groups as soon as they arrive, before downloading
+their attachments or storing them. Direct messages are always allowed.
+"""
+
+from logging import getLogger
+from typing import List, Optional, Set
+
+import redis.asyncio
+
+from utils.redis import subscribe_forever
+
+from .dataclasses import IncomingMessage
+
+logger = getLogger(__name__)
+
+WHITELIST_KEY = "whitelisted_groups"
+WHITELIST_UPDATED_CHANNEL = "whitelisted_groups_updated"
+WHITELIST_COMMANDS = ("!whitelist", "!blacklist")
+
+
+def get_group_id(message: IncomingMessage) -> Optional[str]:
+    """The ID of the group the message was sent in, or None if it wasn't."""
+    try:
+        return message.envelope.dataMessage.groupInfo.groupId
+    except AttributeError:
+        return None
+
+
+def is_whitelist_command(message: IncomingMessage, admins: List[str]) -> bool:
+    """Is this an admin (un)whitelisting the group it's sent in?"""
+    if message.envelope.sourceNumber not in admins:
+        return False
+    return message.envelope.dataMessage.message in WHITELIST_COMMANDS
+
+
+class WhitelistCache:
+    def __init__(self):
+        # Not loaded until it's first needed
+        self.groups: Optional[Set[str]] = None
+
+    async def reload(self, client: redis.asyncio.Redis):
+        members = await client.smembers(WHITELIST_KEY)
+        self.groups = {member.decode() for member in members}
+        logger.info(f"Loaded {len(self.groups)} whitelisted groups")
+
+    async def allows(
+        self,
+        client: redis.asyncio.Redis,
+        message: IncomingMessage,
+        admins: List[str],
+    ) -> bool:
+        """Should the message be processed? Admins' whitelist commands
+        always are, so that they can reach the brain."""
+        gid = get_group_id(message)
+        if gid is None:
+            return True
+
+        if self.groups is None:
+            await self.reload(client)
+
+        return gid in self.groups or is_whitelist_command(message, admins)
+
+    async def listen(self, client: redis.asyncio.Redis):
+        """Reload the whitelist whenever the brain reports that it's
+        changed."""
+
+        async def reload(*_):
+            await self.reload(client)
+
+        await subscribe_forever(
+            client, WHITELIST_UPDATED_CHANNEL, reload, reload
+        )
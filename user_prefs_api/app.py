@@ -9,15 +9,17 @@ from flask_cors import CORS
 
 from signal_interface.dataclasses import OutgoingMessage
 from utils.configuration import Config
-from utils.local_storage import load_file, load_phonebook
+from utils.local_storage import load_file
 from utils.mongo import (
+    PREFERENCES_UPDATED_CHANNEL,
     UserPreferencesUpdate,
     clear_user_preferences,
-    get_mongo_db,
+    get_preferences_collection,
     get_user_preferences,
-    initialize_preferences_collection,
     update_user_preferences,
 )
+from utils.phonebook_store import phonebook_store
+from utils.redis import get_redis_client
 
 from .utils import fetch_cached_otp, get_otp, publish_message
 
@@ -28,8 +30,10 @@ redis_config = config.redis
 
 rabbit_config = config.rabbitmq
 
-db = get_mongo_db(config.mongodb)
-preferences_collection = initialize_preferences_collection(db)
+preferences_collection = get_preferences_collection(config.mongodb)
+
+# Used to tell the brain to drop its cached copy of a user's preferences
+redis_client = get_redis_client(redis_config)
 
 app = Flask(__name__)
 CORS(
@@ -117,6 +121,7 @@ def update_preferences():
     try:
         update_data = UserPreferencesUpdate(**request.json)
         update_user_preferences(preferences_collection, user_id, update_data)
+        redis_client.publish(PREFERENCES_UPDATED_CHANNEL, user_id)
         return jsonify({"message": "Preferences updated"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -130,6 +135,7 @@ def delete_preferences():
         return jsonify({"error": "user_id is required"}), 400
     try:
         clear_user_preferences(preferences_collection, user_id)
+        redis_client.publish(PREFERENCES_UPDATED_CHANNEL, user_id)
         return jsonify({"message": "Preferences cleared"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -144,10 +150,8 @@ async def issue_otp():
     if user_id.startswith("0"):
         user_id = "+44" + user_id[1:]
 
-    phonebook = load_phonebook()
-    app.logger.info(phonebook.contacts)
     app.logger.info(f"Do we have {user_id}?")
-    contact = phonebook.get_contact(user_id)
+    contact = phonebook_store.get_contact(user_id)
     app.logger.info(contact)
 
     # Issue an OTP here
@@ -189,7 +193,7 @@ def verify_otp():
 
     if stored_otp == otp:
         # Get the corresponding UUID, and use that rather than a phone number
-        user_id = load_phonebook().get_contact(user_id).uuid
+        user_id = phonebook_store.get_contact(user_id).uuid
 
         exp = datetime.now() + timedelta(days=config.general.jwt_expiry_days)
         payload = {
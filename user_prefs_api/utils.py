@@ -4,16 +4,14 @@ from logging import getLogger
 import aio_pika
 
 from signal_interface.dataclasses import OutgoingMessage
-from utils.local_storage import load_phonebook
+from utils.phonebook_store import phonebook_store
 from utils.redis import RedisCredentials, get_redis_client
 
 logger = getLogger(__name__)
 
 
 def get_otp(user_phone_number: str, redis_config: RedisCredentials, expiry=60):
-    phonebook = load_phonebook()
-
-    contact = phonebook.get_contact(user_phone_number)
+    contact = phonebook_store.get_contact(user_phone_number)
     if not contact:
         raise ValueError(
             f"Contact with phone number {user_phone_number} not found"
@@ -31,9 +29,7 @@ def get_otp(user_phone_number: str, redis_config: RedisCredentials, expiry=60):
 
 
 def fetch_cached_otp(user_phone_number: str, redis_config: RedisCredentials):
-    phonebook = load_phonebook()
-
-    contact = phonebook.get_contact(user_phone_number)
+    contact = phonebook_store.get_contact(user_phone_number)
     logger.info(f"Checking OTP for {contact.uuid}")
 
     client = get_redis_client(redis_config)
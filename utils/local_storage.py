@@ -1,11 +1,12 @@
-import json
+import fcntl
 import os
+import shutil
+import tempfile
+import time
 from contextlib import contextmanager
 from logging import getLogger
 from typing import IO, Generator, Optional
 
-from .phonebook import PhoneBook
-
 logger = getLogger(__name__)
 
 DATA_DIR = os.environ.get("DATA_DIR", "data")
@@ -36,67 +37,160 @@ def load_file(fname: str, mode="r") -> Optional[str]:
     raise FileNotFoundError(f"File {fname} not found.")
 
 
+def file_mtime(fname: str) -> Optional[int]:
+    """Return the modification time of a file in nanoseconds, or None if it
+    doesn't exist. Files written through file_lock are replaced atomically,
+    so a change in mtime means a complete new version of the file."""
+    try:
+        return os.stat(os.path.join(DATA_DIR, fname)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
 def save_file(fname: str, data: str):
-    """Save a file to disk."""
-    fname = os.path.join(DATA_DIR, fname)
+    """Save a file to disk. The file is replaced atomically."""
     logger.debug(f"Saving data to {fname}: {data}")
 
-    if not os.path.exists(os.path.dirname(fname)):
-        os.makedirs(os.path.dirname(fname))
-
-    with open(fname, "w") as f:
+    with file_lock(fname, "w") as f:
         f.write(data)
 
 
+class FileLockTimeout(TimeoutError):
+    pass
+
+
 @contextmanager
-def file_lock(fname, mode="r+") -> Generator[IO, None, None]:
-    """Get a lock for a file.
+def _flock(
+    lockfile: str, shared: bool, timeout: Optional[float]
+) -> Generator[None, None, None]:
+    """Hold a kernel (flock) lock on the lockfile. The lock is released when
+    the file descriptor is closed, which also happens if the process dies, so
+    a crashed writer can never leave a stale lock behind.
+
+    With no timeout, this blocks in the kernel until the lock is free. With a
+    timeout, it polls with a backoff, and raises FileLockTimeout if the lock
+    isn't acquired in time.
+    """
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
 
-    Note that this has no queueing mechanism, so if two processes try to
-    acquire a lock at the same time (for example, if they are both waiting for
-    the same process to release the lock), they may encounter a race condition.
+    fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if timeout is None:
+            fcntl.flock(fd, operation)
+        else:
+            deadline = time.monotonic() + timeout
+            delay = 0.001
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise FileLockTimeout(
+                            f"Timed out waiting for lock on {lockfile}"
+                        )
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+
+        yield
+    finally:
+        os.close(fd)
 
-    In other words, this ONLY reliably prevents two processes from writing to
-    the same file at the same time. It does not prevent three.
 
-    # TODO: Address the race condition. Some external packages exist,
-    # maybe use that. https://pypi.org/project/portalocker/
+@contextmanager
+def file_lock(
+    fname: str, mode: str = "r+", timeout: Optional[float] = None
+) -> Generator[IO, None, None]:
+    """Open a file in the data directory while holding a lock on it.
+
+    Read-only modes ("r", "rb") take a shared lock, so any number of readers
+    can hold it at once. Any mode that writes takes an exclusive lock, and
+    works on a temporary copy of the file which atomically replaces the
+    original when the block exits cleanly. If the block raises, the original
+    file is left untouched. This means readers never see a half-written file,
+    even if they don't take the lock. The default "r+" is a writing mode, so
+    read-modify-write updates (e.g. the LLM usage log) are atomic too, at the
+    cost of a copy and an fsync each time.
+
+    If the file doesn't exist yet, it is created empty.
+
+    The lock lives in a separate "<fname>.lock" file, since the file itself is
+    replaced on every write. Lock files are left in place, as removing one
+    while another process has it open would let two writers in at once; so
+    only use this for shared files, and atomic_write for the rest.
+
+    If timeout is given, FileLockTimeout is raised if the lock can't be
+    acquired within that many seconds.
     """
     lockfile = os.path.join(DATA_DIR, f"{fname}.lock")
     fname = os.path.join(DATA_DIR, fname)
-
-    if os.path.exists(lockfile):
-        logger.debug(f"Waiting for lock on {fname} to be released...")
-        while os.path.exists(lockfile):
-            pass
-    logger.debug(f"Lock on {fname} acquired.")
+    writing = any(c in mode for c in "wa+")
 
     # Check that the directory we're using exists
-    if not os.path.exists(os.path.dirname(fname)):
-        os.makedirs(os.path.dirname(fname))
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
 
-    # If the file doesn't exist yet, create it
-    if not os.path.exists(fname):
-        open(fname, "w").close()
+    with _flock(lockfile, shared=not writing, timeout=timeout):
+        logger.debug(f"Lock on {fname} acquired.")
 
-    with open(lockfile, "w") as f:
-        f.write("locked")
-        with open(fname, mode) as f:
+        if not writing:
+            # If the file doesn't exist yet, it reads as empty
+            if not os.path.exists(fname):
+                open(fname, "a").close()
+
+            with open(fname, mode) as f:
+                yield f
+
+            logger.debug(f"Lock on {fname} released.")
+            return
+
+        with _replace_atomically(fname, mode) as f:
             yield f
 
-    os.remove(lockfile)
     logger.debug(f"Lock on {fname} released.")
 
 
-def load_phonebook() -> PhoneBook:
-    """Load the phonebook from a file."""
-    fname = os.path.join(DATA_DIR, "phonebook.json")
-    logger.debug(f"Loading phonebook from {fname}")
+@contextmanager
+def atomic_write(fname: str, mode: str = "w") -> Generator[IO, None, None]:
+    """Write a file in the data directory in the same way as file_lock, but
+    without taking a lock. This is for files that only ever have one writer,
+    e.g. attachments, which are named by their unique IDs, so that writers
+    don't leave lock files behind, or block while holding a lock.
+    """
+    fname = os.path.join(DATA_DIR, fname)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
 
+    with _replace_atomically(fname, mode) as f:
+        yield f
+
+
+@contextmanager
+def _replace_atomically(fname: str, mode: str) -> Generator[IO, None, None]:
+    """Open a temporary copy of the file, which replaces the original when
+    the block exits cleanly, and is discarded if it raises."""
+    fd, tmp_name = tempfile.mkstemp(
+        dir=os.path.dirname(fname),
+        prefix=f".{os.path.basename(fname)}.",
+        suffix=".tmp",
+    )
+    os.close(fd)
     try:
-        with open(fname, "r") as f:
-            return PhoneBook(**json.load(f))
-    except FileNotFoundError:
-        return PhoneBook()
-    except json.JSONDecodeError:
-        return PhoneBook()
+        # Modes that don't truncate start from the current contents. The
+        # new file keeps the original's permissions; mkstemp makes it 0600.
+        if os.path.exists(fname):
+            if "w" not in mode:
+                shutil.copyfile(fname, tmp_name)
+            shutil.copymode(fname, tmp_name)
+        else:
+            os.chmod(tmp_name, 0o644)
+
+        with open(tmp_name, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_name, fname)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
@@ -1,12 +1,16 @@
+import os
+import threading
+import time
+from collections import OrderedDict
 from logging import getLogger
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 import pymongo
 from pydantic import BaseModel, model_validator
 from pymongo.collection import Collection
 from pymongo.database import Database
 
-from .local_storage import load_file
+from .prompts import PromptRegistry
 
 logger = getLogger(__name__)
 
@@ -22,13 +26,11 @@ DEFAULTS = {
 }
 
 
+default_prompts = PromptRegistry(DEFAULTS)
+
+
 def load_default_value(key: str) -> str:
-    data = load_file(DEFAULTS[key])
-    if not data:
-        logger.error(f"Could not load default value for {key}")
-        raise FileNotFoundError(f"Could not load default value for {key}")
-    data = data.strip()
-    return data
+    return default_prompts.get(key)
 
 
 class UserPreferences(BaseModel):
@@ -69,23 +71,54 @@ class UserPreferencesUpdate(BaseModel):
         extra = "forbid"
 
 
+# Redis pub/sub channel on which the user preferences API announces the IDs of
+# users whose preferences have changed.
+PREFERENCES_UPDATED_CHANNEL = "user_preferences_updated"
+
+
 class MongoConfig(BaseModel):
     host: str
     port: int
     db: str
     user: Optional[str] = None
     password: Optional[str] = None
+    max_pool_size: int = 20
 
 
-def get_mongo_db(config: MongoConfig) -> Database:
+# MongoClients are pooled and thread-safe, but not fork-safe, so one is kept
+# per process.
+_clients: Dict[Tuple, pymongo.MongoClient] = {}
+_collections: Dict[Tuple, Collection] = {}
+_clients_lock = threading.Lock()
+
+
+def _client_key(config: MongoConfig) -> Tuple:
+    return (os.getpid(), config.host, config.port, config.user)
 
-    host = (
-        f"mongodb://{config.user}:{config.password}@{config.host}"
-        if config.user
-        else f"mongodb://{config.host}"
-    )
 
-    client = pymongo.MongoClient(host, port=config.port, connect=True)
+def get_mongo_client(config: MongoConfig) -> pymongo.MongoClient:
+    """Return this process' shared client for the given server."""
+    key = _client_key(config)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            host = (
+                f"mongodb://{config.user}:{config.password}@{config.host}"
+                if config.user
+                else f"mongodb://{config.host}"
+            )
+            client = pymongo.MongoClient(
+                host,
+                port=config.port,
+                maxPoolSize=config.max_pool_size,
+                connect=False,
+            )
+            _clients[key] = client
+    return client
+
+
+def get_mongo_db(config: MongoConfig) -> Database:
+    client = get_mongo_client(config)
 
     db = client[config.db]
 
@@ -103,6 +136,64 @@ def initialize_preferences_collection(
     return collection
 
 
+def get_preferences_collection(config: MongoConfig) -> Collection:
+    """Return the user preferences collection, making sure that its index
+    exists the first time it's used in this process."""
+    key = (*_client_key(config), config.db)
+    collection = _collections.get(key)
+    if collection is None:
+        collection = initialize_preferences_collection(get_mongo_db(config))
+        _collections[key] = collection
+    return collection
+
+
+class UserPreferencesCache:
+    """A thread-safe LRU cache of user preferences, whose entries expire
+    after ttl seconds. Entries should also be invalidated when a user's
+    preferences are changed."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, UserPreferences]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[UserPreferences]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires, preferences = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return preferences
+
+    def put(self, user_id: str, preferences: UserPreferences):
+        with self._lock:
+            self._entries[user_id] = (
+                time.monotonic() + self.ttl,
+                preferences,
+            )
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Drop a user's cached preferences, or everyone's if no user is
+        given."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
 def get_user_preferences(
     collection: Collection, user_id: str
 ) -> UserPreferences:
@@ -1,7 +1,9 @@
+from bisect import insort
+from itertools import count
 from logging import getLogger
-from typing import Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 logger = getLogger(__name__)
 
@@ -30,6 +32,64 @@ class PhoneBook(BaseModel):
     contacts: List[Contact] = []
     groups: Dict[str, Group] = {}
 
+    # Secondary indexes over the contacts list, so that lookups don't have to
+    # scan it. They are built on load and kept in sync by the methods below,
+    # so contacts should only be changed through those methods. Each key maps
+    # to every contact that has it, in the order they appear in the contacts
+    # list, and lookups take the first; if that one's key changes, the next
+    # takes its place.
+    _by_uuid: Dict[str, List[Contact]] = PrivateAttr(default_factory=dict)
+    _by_number: Dict[str, List[Contact]] = PrivateAttr(default_factory=dict)
+    _by_name: Dict[str, List[Contact]] = PrivateAttr(default_factory=dict)
+    # Each contact's position in the contacts list, by id()
+    _positions: Dict[int, int] = PrivateAttr(default_factory=dict)
+    _next_position: Any = PrivateAttr(default_factory=count)
+
+    def model_post_init(self, __context: Any):
+        for contact in self.contacts:
+            self._positions[id(contact)] = next(self._next_position)
+            self._index_contact(contact)
+
+    def _position(self, contact: Contact) -> int:
+        return self._positions[id(contact)]
+
+    def _indexes(self, contact: Contact):
+        return (
+            (self._by_uuid, contact.uuid),
+            (self._by_number, contact.number),
+            (self._by_name, contact.name),
+        )
+
+    def _index_contact(self, contact: Contact):
+        for index, key in self._indexes(contact):
+            if key is not None:
+                insort(index.setdefault(key, []), contact, key=self._position)
+
+    def _unindex_contact(self, contact: Contact):
+        for index, key in self._indexes(contact):
+            if key is None or key not in index:
+                continue
+            index[key] = [c for c in index[key] if c is not contact]
+            if not index[key]:
+                del index[key]
+
+    @staticmethod
+    def _lookup(
+        index: Dict[str, List[Contact]], key: Optional[str]
+    ) -> Optional[Contact]:
+        if key is None or key not in index:
+            return None
+        return index[key][0]
+
+    def _find_contact(
+        self, uuid: Optional[str] = None, number: Optional[str] = None
+    ) -> Optional[Contact]:
+        """Find the contact matching the UUID, or failing that, the number."""
+        contact = self._lookup(self._by_uuid, uuid)
+        if contact is None:
+            contact = self._lookup(self._by_number, number)
+        return contact
+
     def add_contact(self, contact: Contact):
         """Depending on signal's inscrutable whims, contacts may be identified
         by either a UUID or a phone number. Names are also sometimes, for
@@ -38,24 +98,18 @@ class PhoneBook(BaseModel):
         information. Otherwise, add the new contact to the phonebook.
         """
 
-        for existing_contact in self.contacts:
-            if (
-                (
-                    contact.uuid is not None
-                    and existing_contact.uuid == contact.uuid
-                )
-                or contact.number is not None
-                and existing_contact.number == contact.number
-            ):
-                self.update_contact(
-                    uuid=contact.uuid,
-                    number=contact.number,
-                    name=contact.name,
-                    profile=contact.profile,
-                )
-                return
+        if self._find_contact(contact.uuid, contact.number) is not None:
+            self.update_contact(
+                uuid=contact.uuid,
+                number=contact.number,
+                name=contact.name,
+                profile=contact.profile,
+            )
+            return
 
         self.contacts.append(contact)
+        self._positions[id(contact)] = next(self._next_position)
+        self._index_contact(contact)
 
     def update_contact(
         self,
@@ -74,29 +128,30 @@ class PhoneBook(BaseModel):
         contact was created. Returns False if an existing contact was found,
         but was not updated.
         """
-        for contact in self.contacts:
-            if (uuid is not None and contact.uuid == uuid) or (
-                number is not None and contact.number == number
-            ):
-                updated = False
+        contact = self._find_contact(uuid, number)
+        if contact is not None:
+            # Pull the contact out of the indexes while its keys change
+            self._unindex_contact(contact)
+            updated = False
 
-                if name is not None and contact.name != name:
-                    contact.name = name
-                    updated = True
+            if name is not None and contact.name != name:
+                contact.name = name
+                updated = True
 
-                if profile is not None and contact.profile != profile:
-                    contact.profile = profile
-                    updated = True
+            if profile is not None and contact.profile != profile:
+                contact.profile = profile
+                updated = True
 
-                if number is not None and contact.number != number:
-                    contact.number = number
-                    updated = True
+            if number is not None and contact.number != number:
+                contact.number = number
+                updated = True
 
-                if uuid is not None and contact.uuid != uuid:
-                    contact.uuid = uuid
-                    updated = True
+            if uuid is not None and contact.uuid != uuid:
+                contact.uuid = uuid
+                updated = True
 
-                return updated
+            self._index_contact(contact)
+            return updated
 
         # If no contact matches by UUID or number, create a new one if name or
         # number is provided
@@ -120,19 +175,26 @@ class PhoneBook(BaseModel):
         at least one, though "Name" may sometimes be a phone number (in this
         case, the phone number field is also populated with the same value)
 
-        This function will return the first contact
-        that matches any of its fields with the given identifier.
+        This function will return the first contact whose UUID or number
+        matches any of the given identifiers. Names aren't unique, so they
+        aren't matched here; see get_contact_by_name.
         """
         # Get a list of all the identifiers I've been passed
         identifiers = [identifier, *other_identifiers]
 
-        for contact in self.contacts:
+        for index in (self._by_uuid, self._by_number):
             for id in identifiers:
-                if id in [contact.uuid, contact.number]:
+                contact = self._lookup(index, id)
+                if contact is not None:
                     return contact
 
         return None
 
+    def get_contact_by_name(self, name: str) -> Optional[Contact]:
+        """Return the first contact with the given name. Several contacts may
+        share a name, so prefer get_contact where there's a UUID or number."""
+        return self._lookup(self._by_name, name)
+
     def add_group(self, group: Dict[str, Union[str, List[str]]]):
         logger.info(f"Creating group from {group}")
 
@@ -141,9 +203,8 @@ class PhoneBook(BaseModel):
         members: List[Contact] = []
         logger.info(f"Group members: {group['members']}")
         for member in group["members"]:
-            if member in self.contacts:
-                contact = self.get_contact(member)
-            else:
+            contact = self.get_contact(member)
+            if contact is None:
                 # Group chats identify their members by phone number, AFAIK
                 contact = Contact(number=member)
                 logger.info(
@@ -0,0 +1,264 @@
+"""Persistent storage for the phonebook.
+
+The phonebook lives in a SQLite database in the data directory, in WAL mode,
+so that any number of processes can read it while one writes. Contacts and
+groups are stored one row per record, so updating a contact or syncing a
+group only touches the affected rows, rather than rewriting the whole
+phonebook.
+
+The old `phonebook.json` file is imported the first time the database is
+opened, if the database is empty.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from logging import getLogger
+from typing import Dict, Iterable, Optional
+
+from .local_storage import DATA_DIR
+from .phonebook import Contact, Group, PhoneBook
+
+logger = getLogger(__name__)
+
+PHONEBOOK_DB = "phonebook.db"
+LEGACY_PHONEBOOK = "phonebook.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT,
+    number TEXT,
+    name TEXT,
+    profile TEXT
+);
+CREATE INDEX IF NOT EXISTS contacts_uuid ON contacts (uuid);
+CREATE INDEX IF NOT EXISTS contacts_number ON contacts (number);
+CREATE INDEX IF NOT EXISTS contacts_name ON contacts (name);
+
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY,
+    internal_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+
+def _row_to_contact(row: sqlite3.Row) -> Contact:
+    return Contact(
+        uuid=row["uuid"],
+        number=row["number"],
+        name=row["name"],
+        profile=row["profile"],
+    )
+
+
+class PhoneBookStore:
+    """Reads and writes individual phonebook records.
+
+    SQLite connections can't be shared between threads or across a fork, so
+    each thread of each process lazily opens its own.
+    """
+
+    def __init__(self, fname: str = PHONEBOOK_DB):
+        self.path = os.path.join(DATA_DIR, fname)
+        self._local = threading.local()
+
+        # Process-local cache of group id -> internal id. See
+        # resolve_group_internal_id.
+        self._group_ids: Dict[str, str] = {}
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "connection", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.connection = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        logger.debug(f"Opening phonebook database at {self.path}")
+        # Transactions are managed explicitly, below
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        self._migrate_legacy_file(conn)
+        return conn
+
+    def _migrate_legacy_file(self, conn: sqlite3.Connection):
+        """One-shot import of phonebook.json into an empty database. The JSON
+        file is renamed afterwards, so this only ever happens once."""
+        legacy_path = os.path.join(DATA_DIR, LEGACY_PHONEBOOK)
+        if not os.path.isfile(legacy_path):
+            return
+
+        try:
+            with open(legacy_path, "r") as f:
+                phonebook = PhoneBook(**json.load(f))
+        except json.JSONDecodeError:
+            phonebook = PhoneBook()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have beaten us to it
+            has_contacts = conn.execute("SELECT 1 FROM contacts LIMIT 1")
+            has_groups = conn.execute("SELECT 1 FROM groups LIMIT 1")
+            if not has_contacts.fetchone() and not has_groups.fetchone():
+                logger.info(
+                    f"Migrating {len(phonebook.contacts)} contacts and"
+                    f" {len(phonebook.groups)} groups from {legacy_path}"
+                )
+                for contact in phonebook.contacts:
+                    self._insert_contact(conn, contact)
+                for group in phonebook.groups.values():
+                    self._upsert_group(conn, group)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        try:
+            os.replace(legacy_path, f"{legacy_path}.migrated")
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _insert_contact(conn: sqlite3.Connection, contact: Contact):
+        conn.execute(
+            "INSERT INTO contacts (uuid, number, name, profile)"
+            " VALUES (?, ?, ?, ?)",
+            (contact.uuid, contact.number, contact.name, contact.profile),
+        )
+
+    def _upsert_contact(self, conn: sqlite3.Connection, contact: Contact):
+        """Merge the contact into the row with the same UUID, or failing that
+        the same number, in the same way as PhoneBook.update_contact. Fields
+        that are None on the given contact are left as they are."""
+        row = None
+        if contact.uuid is not None:
+            row = conn.execute(
+                "SELECT id FROM contacts WHERE uuid = ? ORDER BY id LIMIT 1",
+                (contact.uuid,),
+            ).fetchone()
+        if row is None and contact.number is not None:
+            row = conn.execute(
+                "SELECT id FROM contacts WHERE number = ? ORDER BY id LIMIT 1",
+                (contact.number,),
+            ).fetchone()
+
+        if row is None:
+            self._insert_contact(conn, contact)
+            return
+
+        conn.execute(
+            "UPDATE contacts SET"
+            " uuid = COALESCE(?, uuid),"
+            " number = COALESCE(?, number),"
+            " name = COALESCE(?, name),"
+            " profile = COALESCE(?, profile)"
+            " WHERE id = ?",
+            (
+                contact.uuid,
+                contact.number,
+                contact.name,
+                contact.profile,
+                row["id"],
+            ),
+        )
+
+    @staticmethod
+    def _upsert_group(conn: sqlite3.Connection, group: Group):
+        conn.execute(
+            "INSERT INTO groups (id, internal_id, data) VALUES (?, ?, ?)"
+            " ON CONFLICT (id) DO UPDATE SET"
+            " internal_id = excluded.internal_id, data = excluded.data",
+            (group.id, group.internal_id, group.model_dump_json()),
+        )
+
+    def upsert(
+        self,
+        contacts: Iterable[Contact] = (),
+        groups: Iterable[Group] = (),
+    ):
+        """Write the given contacts and groups, in a single transaction."""
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for contact in contacts:
+                self._upsert_contact(conn, contact)
+            for group in groups:
+                self._upsert_group(conn, group)
+                self._group_ids.pop(group.id, None)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def load(self) -> PhoneBook:
+        """Read the whole phonebook."""
+        conn = self.connection
+        contacts = [
+            _row_to_contact(row)
+            for row in conn.execute("SELECT * FROM contacts ORDER BY id")
+        ]
+        groups = {
+            row["id"]: Group.model_validate_json(row["data"])
+            for row in conn.execute("SELECT id, data FROM groups")
+        }
+        return PhoneBook(contacts=contacts, groups=groups)
+
+    def get_contact(
+        self, identifier: str, *other_identifiers: str
+    ) -> Optional[Contact]:
+        """Look up a single contact, with the same matching rules as
+        PhoneBook.get_contact."""
+        identifiers = [
+            id for id in (identifier, *other_identifiers) if id is not None
+        ]
+        conn = self.connection
+        for column in ("uuid", "number"):
+            for id in identifiers:
+                row = conn.execute(
+                    f"SELECT * FROM contacts WHERE {column} = ?"
+                    " ORDER BY id LIMIT 1",
+                    (id,),
+                ).fetchone()
+                if row is not None:
+                    return _row_to_contact(row)
+
+        return None
+
+    def get_group_internal_id(self, group_id: str) -> str:
+        """Return the internal_id for a given group id."""
+        row = self.connection.execute(
+            "SELECT internal_id FROM groups WHERE id = ?", (group_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(group_id)
+        return row["internal_id"]
+
+    def resolve_group_internal_id(self, group_id: str) -> str:
+        """Cached version of get_group_internal_id, for the hot path.
+
+        Signal derives a group's public id from its internal id, so a cached
+        mapping can't go stale in another process; only new groups miss the
+        cache and go to the database. Groups written through this store are
+        dropped from the cache all the same.
+        """
+        internal_id = self._group_ids.get(group_id)
+        if internal_id is None:
+            internal_id = self.get_group_internal_id(group_id)
+            self._group_ids[group_id] = internal_id
+        return internal_id
+
+
+phonebook_store = PhoneBookStore()
+
+
+def load_phonebook() -> PhoneBook:
+    """Load the phonebook from storage."""
+    return phonebook_store.load()
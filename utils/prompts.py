@@ -0,0 +1,79 @@
+"""Prompt templates, loaded from the data directory.
+
+Templates are read once and shared, and re-read when the file on disk
+changes, so prompts can be edited without restarting anything. Checking for
+changes is just a stat, and is done at most once every `check_interval`
+seconds per template.
+"""
+
+import threading
+import time
+from logging import getLogger
+from typing import Dict, Mapping, Optional, Tuple
+
+from .local_storage import file_mtime, load_file
+
+logger = getLogger(__name__)
+
+
+class PromptRegistry:
+    def __init__(self, files: Mapping[str, str], check_interval: float = 5.0):
+        self.files = dict(files)
+        self.check_interval = check_interval
+
+        # key -> (mtime, template)
+        self._templates: Dict[str, Tuple[Optional[int], str]] = {}
+        # key -> when we last checked the file for changes
+        self._checked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.files
+
+    def get(self, key: str) -> str:
+        """Return the current template for key. Raises a KeyError for unknown
+        keys, and a FileNotFoundError if the template has never been
+        loadable."""
+        fname = self.files[key]
+
+        now = time.monotonic()
+        cached = self._templates.get(key)
+        if cached and now - self._checked.get(key, 0.0) < self.check_interval:
+            return cached[1]
+
+        with self._lock:
+            self._checked[key] = now
+            mtime = file_mtime(fname)
+            cached = self._templates.get(key)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+            try:
+                template = self._load(key, fname)
+            except FileNotFoundError:
+                # Keep serving the last good version, if we have one
+                if cached:
+                    logger.error(
+                        f"Could not reload {fname}, keeping the old version"
+                    )
+                    return cached[1]
+                raise
+
+            if cached:
+                logger.info(f"Reloaded prompt template {fname}")
+            self._templates[key] = (mtime, template)
+            return template
+
+    @staticmethod
+    def _load(key: str, fname: str) -> str:
+        data = load_file(fname)
+        if not data:
+            logger.error(f"Could not load default value for {key}")
+            raise FileNotFoundError(f"Could not load default value for {key}")
+        return data.strip()
+
+    def invalidate(self):
+        """Force every template to be re-read on next use."""
+        with self._lock:
+            self._templates.clear()
+            self._checked.clear()
@@ -0,0 +1,169 @@
+"""Per-user and per-chat quotas on LLM use, kept in Redis.
+
+Two kinds of limit are enforced, each for both the user making a request and
+the chat it's made in:
+- requests per minute, counted over a sliding window (as in rate_limit.py)
+- tokens per day, counted per UTC day
+
+A request is checked against all four limits, and counted towards both
+request limits, in a single Lua script, so concurrent requests can't both
+squeeze under a limit. Tokens can only be counted once the LLM has replied,
+so they're added afterwards; a request that's allowed may take a user over
+their token limit, which then stops their next one.
+
+Requests that the user didn't ask for (e.g. the Razzler chiming in on a busy
+chat) are only checked and counted against the chat's limits, so that they
+don't use up the user's quota for the requests they do make.
+"""
+
+import secrets
+from datetime import datetime, timezone
+from logging import getLogger
+from typing import Optional
+
+import redis.asyncio
+from pydantic import BaseModel
+
+from .redis import get_script
+
+logger = getLogger(__name__)
+
+
+class QuotaConfig(BaseModel):
+    # None means no limit
+    user_requests_per_minute: Optional[int] = 6
+    chat_requests_per_minute: Optional[int] = 20
+    user_tokens_per_day: Optional[int] = None
+    chat_tokens_per_day: Optional[int] = None
+
+
+# KEYS: user requests, chat requests, user tokens today, chat tokens today
+# ARGV: window (ms), then the limits in the same order as KEYS (negative for
+# no limit), then an ID for this request, then 1 to count it against the
+# user's limits as well as the chat's, or 0 not to.
+# Returns an empty string if the request is allowed, or else the name of the
+# limit that it would break.
+ACQUIRE_SCRIPT = """
+local now = redis.call('TIME')
+now = now[1] * 1000 + math.floor(now[2] / 1000)
+local window = tonumber(ARGV[1])
+local count_user = ARGV[7] == '1'
+
+-- The user's keys are the odd ones
+local function counted(i)
+    return count_user or i % 2 == 0
+end
+
+local names = {'user_requests', 'chat_requests', 'user_tokens', 'chat_tokens'}
+for i = 1, 2 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - window)
+end
+for i = 1, 4 do
+    local limit = tonumber(ARGV[i + 1])
+    if limit >= 0 and counted(i) then
+        local used
+        if i <= 2 then
+            used = redis.call('ZCARD', KEYS[i])
+        else
+            used = tonumber(redis.call('GET', KEYS[i]) or '0')
+        end
+        if used >= limit then
+            return names[i]
+        end
+    end
+end
+
+for i = 1, 2 do
+    if counted(i) then
+        redis.call('ZADD', KEYS[i], now, ARGV[6])
+        redis.call('PEXPIRE', KEYS[i], window)
+    end
+end
+return ''
+"""
+
+REQUEST_WINDOW = 60
+# Token counts are kept a little longer than the day they're for, so that
+# requests right at midnight don't race the expiry
+TOKENS_EXPIRY = 60 * 60 * 48
+
+
+def _limit(value: Optional[int]) -> int:
+    return -1 if value is None else value
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class QuotaEnforcer:
+    def __init__(self, config: QuotaConfig):
+        self.config = config
+
+    @staticmethod
+    def _request_keys(user_id: str, chat_id: str):
+        return (
+            f"quota:requests:user:{user_id}",
+            f"quota:requests:chat:{chat_id}",
+        )
+
+    @staticmethod
+    def _token_keys(user_id: str, chat_id: str):
+        today = _today()
+        return (
+            f"quota:tokens:user:{user_id}:{today}",
+            f"quota:tokens:chat:{chat_id}:{today}",
+        )
+
+    async def acquire(
+        self,
+        client: redis.asyncio.Redis,
+        user_id: str,
+        chat_id: str,
+        prompted: bool = True,
+    ) -> Optional[str]:
+        """Count a request against the quotas, if they allow it. Returns
+        None if the request may go ahead, or the name of the limit that
+        stopped it. Requests that weren't prompted by the user only count
+        against the chat's quotas."""
+        config = self.config
+        acquire = get_script(client, ACQUIRE_SCRIPT)
+        exceeded = await acquire(
+            keys=[
+                *self._request_keys(user_id, chat_id),
+                *self._token_keys(user_id, chat_id),
+            ],
+            args=[
+                REQUEST_WINDOW * 1000,
+                _limit(config.user_requests_per_minute),
+                _limit(config.chat_requests_per_minute),
+                _limit(config.user_tokens_per_day),
+                _limit(config.chat_tokens_per_day),
+                secrets.token_hex(8),
+                1 if prompted else 0,
+            ],
+        )
+        if isinstance(exceeded, bytes):
+            exceeded = exceeded.decode()
+        return exceeded or None
+
+    async def record_tokens(
+        self,
+        client: redis.asyncio.Redis,
+        user_id: str,
+        chat_id: str,
+        tokens: int,
+        prompted: bool = True,
+    ):
+        """Count tokens used by a request against today's quotas. As with
+        acquire, unprompted requests only count against the chat's."""
+        if tokens <= 0:
+            return
+
+        user_key, chat_key = self._token_keys(user_id, chat_id)
+        keys = [user_key, chat_key] if prompted else [chat_key]
+        async with client.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.incrby(key, tokens)
+                pipe.expire(key, TOKENS_EXPIRY)
+            await pipe.execute()
@@ -0,0 +1,68 @@
+"""Sliding window event limits, kept in Redis.
+
+Each key is a sorted set of events, scored by the time they happened (by the
+Redis server's clock, so all processes agree). Counting the events in the
+last N seconds is then a single ZCOUNT, and events older than the counter's
+retention are dropped whenever a new one is recorded. The key expires once
+nothing has been recorded for the retention period, so idle counters don't
+hang around.
+
+Checking the limit and recording the event happen in one Lua script, so are
+atomic. This works with both the blocking and the asyncio Redis clients;
+with the asyncio client, await the result.
+"""
+
+import secrets
+from typing import Union
+
+import redis
+import redis.asyncio
+
+from .redis import get_script
+
+# KEYS: counter. ARGV: retention (ms), window (ms), limit, event ID
+# Records the event if that keeps the count in the window within the limit.
+# Returns {recorded (0 or 1), count in the window afterwards}. A negative
+# limit means no limit.
+RECORD_SCRIPT = """
+local now = redis.call('TIME')
+now = now[1] * 1000 + math.floor(now[2] / 1000)
+local retention = tonumber(ARGV[1])
+local limit = tonumber(ARGV[3])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - retention)
+local count = redis.call('ZCOUNT', KEYS[1], '(' .. (now - ARGV[2]), '+inf')
+if limit >= 0 and count >= limit then
+    return {0, count}
+end
+
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], retention)
+return {1, count + 1}
+"""
+
+Client = Union[redis.Redis, redis.asyncio.Redis]
+
+
+class SlidingWindowCounter:
+    """Counts events per key over sliding windows of up to `retention`
+    seconds. Different callers can count the same events over different
+    windows, as long as none is longer than the retention."""
+
+    def __init__(self, retention: float):
+        self.retention_ms = int(retention * 1000)
+
+    def hit(self, client: Client, key: str, window: float, limit: int):
+        """Record an event only if that keeps the count over the last
+        `window` seconds within `limit`. Returns a pair of whether it was
+        recorded, and the count afterwards."""
+        script = get_script(client, RECORD_SCRIPT)
+        return script(
+            keys=[key],
+            args=[
+                self.retention_ms,
+                int(window * 1000),
+                limit,
+                secrets.token_hex(8),
+            ],
+        )
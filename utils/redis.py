@@ -1,15 +1,103 @@
-from typing import Optional
+import asyncio
+from logging import getLogger
+from typing import Awaitable, Callable, Optional, Union
+from weakref import WeakKeyDictionary
 
 import redis
+import redis.asyncio
 from pydantic import BaseModel
 
+logger = getLogger(__name__)
+
 
 class RedisCredentials(BaseModel):
     host: str = "localhost"
     port: int = 6379
     db: int = 0
     password: Optional[str] = None
+    # Upper bound on pooled connections, per client
+    max_connections: int = 50
+    # Idle connections are PINGed before reuse if they've been idle for
+    # longer than this many seconds, so dead sockets are caught early.
+    health_check_interval: int = 30
 
 
 def get_redis_client(redis_config: RedisCredentials) -> redis.Redis:
     return redis.Redis(**redis_config.model_dump(), decode_responses=True)
+
+
+def get_async_redis_client(
+    redis_config: RedisCredentials,
+) -> redis.asyncio.Redis:
+    """Build a pooled asyncio Redis client. No connections are made until the
+    client is first used, so this is safe to call before the event loop
+    exists. Responses are returned as bytes."""
+    pool = redis.asyncio.ConnectionPool(
+        host=redis_config.host,
+        port=redis_config.port,
+        db=redis_config.db,
+        password=redis_config.password,
+        max_connections=redis_config.max_connections,
+        health_check_interval=redis_config.health_check_interval,
+    )
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+# Lua scripts registered with each client, by source
+_scripts: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def get_script(client: Union[redis.Redis, redis.asyncio.Redis], source: str):
+    """Register a Lua script with the client, once, and return it. Calling
+    register_script on every use would build (and hash) a new Script each
+    time. Works with both the blocking and asyncio clients."""
+    scripts = _scripts.setdefault(client, {})
+    script = scripts.get(source)
+    if script is None:
+        script = scripts[source] = client.register_script(source)
+    return script
+
+
+async def claim_key(
+    client: redis.asyncio.Redis, key: str, expiry: int
+) -> bool:
+    """Atomically claim a key, with SET NX. Returns True if this call set the
+    key, or False if it was already claimed. Since the check and the set are
+    a single command, only one of several concurrent callers can win.
+
+    The key expires after `expiry` seconds.
+    """
+    return bool(await client.set(key, 1, nx=True, ex=expiry))
+
+
+async def subscribe_forever(
+    client: redis.asyncio.Redis,
+    channel: str,
+    on_subscribe: Callable[[], Awaitable[None]],
+    on_message: Callable[[bytes], Awaitable[None]],
+):
+    """Listen to a pub/sub channel until cancelled, calling on_message with
+    the data of each message. If the subscription is lost, it's re-made.
+
+    Messages published while we weren't subscribed are missed, so
+    on_subscribe is called each time the subscription is (re-)made, to catch
+    up on anything that could have changed.
+    """
+    while True:
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            await on_subscribe()
+
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                await on_message(message["data"])
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Lost subscription to {channel}: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()